@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+""" benchmark.py
+
+    Measure the speed and accuracy of matches.py and the solvers.
+
+    Usage:
+
+        ./benchmark.py [--out results.json] [--seed N] [--per-bucket N]
+                       [--tasks matches,solve,hybrid] [--corpus text.txt]
+                       [--timeout SECS] [--no-memory]
+        ./benchmark.py --compare old_results.json new_results.json
+                       [--threshold FRACTION]
+
+    This generates cryptograms by taking runs of words from a plain text corpus
+    (by default, a built-in sample of public domain prose) and enciphering them
+    with random keys. Everything is seeded, so the same arguments always give
+    the same cryptograms. The cryptograms are bucketed by word count and by
+    length, and each task is run on each cryptogram:
+
+        matches  Decode the distinct cipher words with matches.Search, keeping
+                 the first N_MATCHES results. Nodes are search nodes, and
+                 accuracy is 1 if the true plaintext is among the results.
+        solve    Run solver.solve(). Nodes are annealing steps, and accuracy is
+                 the fraction of letters decrypted correctly.
+        hybrid   Run solver.solve_hybrid(), measured like solve.
+
+    For each run we record the wall time, nodes explored, peak memory (traced
+    in a second, separate run so that tracing doesn't slow the timed run), and
+    accuracy. The results, with per-bucket medians, are written as JSON.
+
+    With --compare, the medians of two results files are compared, and any
+    bucket that got slower or used more memory by more than the threshold
+    fraction, or lost accuracy, is reported as a regression. The exit status is
+    1 if there were any regressions.
+"""
+
+
+# ______________________________________________________________________
+# Imports
+
+import argparse
+import json
+import platform
+import random
+import re
+import statistics
+import string
+import sys
+import time
+import tracemalloc
+
+import matches
+import solver
+
+
+# ______________________________________________________________________
+# Globals and constants
+
+WORD_COUNTS  = (4, 8, 16, 32)
+N_PER_BUCKET = 3
+N_MATCHES    = 10
+TIMEOUT_SEC  = 10.0
+
+# Regressions are changes worse than these.
+SLOWDOWN_THRESHOLD = 0.2
+ACCURACY_DROP      = 0.05
+
+# Times below this are too noisy to flag as regressions.
+MIN_COMPARED_SEC = 0.05
+
+# Lengths, in characters, below which a cryptogram is short or medium.
+LENGTH_CLASSES = ((60, 'short'), (150, 'medium'))
+
+ALL_TASKS = ('matches', 'solve', 'hybrid')
+
+# These are the opening lines of A Tale of Two Cities, Pride and Prejudice,
+# and Moby Dick, and the Gettysburg Address; all are in the public domain.
+DEFAULT_CORPUS = """
+It was the best of times, it was the worst of times, it was the age of
+wisdom, it was the age of foolishness, it was the epoch of belief, it was the
+epoch of incredulity, it was the season of Light, it was the season of
+Darkness, it was the spring of hope, it was the winter of despair, we had
+everything before us, we had nothing before us, we were all going direct to
+Heaven, we were all going direct the other way.
+
+It is a truth universally acknowledged, that a single man in possession of a
+good fortune, must be in want of a wife. However little known the feelings or
+views of such a man may be on his first entering a neighbourhood, this truth
+is so well fixed in the minds of the surrounding families, that he is
+considered the rightful property of some one or other of their daughters.
+
+Call me Ishmael. Some years ago, never mind how long precisely, having little
+or no money in my purse, and nothing particular to interest me on shore, I
+thought I would sail about a little and see the watery part of the world. It
+is a way I have of driving off the spleen and regulating the circulation.
+
+Four score and seven years ago our fathers brought forth on this continent, a
+new nation, conceived in Liberty, and dedicated to the proposition that all
+men are created equal. Now we are engaged in a great civil war, testing
+whether that nation, or any nation so conceived and so dedicated, can long
+endure. We are met on a great battle field of that war.
+"""
+
+
+# ______________________________________________________________________
+# Functions
+
+def get_length_class(text):
+    for max_len, name in LENGTH_CLASSES:
+        if len(text) < max_len:
+            return name
+    return 'long'
+
+def make_cryptograms(corpus, seed, per_bucket):
+    """ Return a list of case dicts, each with a plaintext, its cryptogram, and
+        the key used to make it.
+    """
+    rng = random.Random(seed)
+    words = corpus.lower().split()
+    cases = []
+    for num_words in WORD_COUNTS:
+        for i in range(per_bucket):
+            start = rng.randrange(max(1, len(words) - num_words + 1))
+            plain = ' '.join(words[start:start + num_words])
+            key = list(string.ascii_lowercase)
+            rng.shuffle(key)
+            crypt = plain.translate(str.maketrans(string.ascii_lowercase,
+                                                  ''.join(key)))
+            cases.append({
+                'id': f'{num_words}w-{i}',
+                'bucket': f'{num_words} words, {get_length_class(plain)}',
+                'num_words': len(plain.split()),
+                'length': len(plain),
+                'plain': plain,
+                'crypt': crypt
+            })
+    return cases
+
+def get_letter_accuracy(plain, decrypted):
+    """ Return the fraction of the letters of `plain` that `decrypted` gets
+        right.
+    """
+    pairs = [(p, d) for p, d in zip(plain, decrypted) if p.isalpha()]
+    return sum(p == d for p, d in pairs) / max(1, len(pairs))
+
+def run_matches(case, timeout):
+    """ Return (nodes, accuracy) for decoding the case's distinct cipher words.
+    """
+    plain_words = re.findall('[a-z]+', case['plain'])
+    cipher_words = re.findall('[a-z]+', case['crypt'])
+    ciphers = sorted(set(cipher_words))
+    true_words = [plain_words[cipher_words.index(c)] for c in ciphers]
+
+    matcher = matches.Matcher()
+    search = matches.Search(ciphers, [matcher.get_domain(c) for c in ciphers])
+    search.deadline = time.monotonic() + timeout
+    found = False
+    try:
+        for i, (_, words, _) in enumerate(search.find_matches()):
+            if words == true_words:
+                found = True
+            if found or i + 1 == N_MATCHES:
+                break
+    except TimeoutError:
+        pass
+    return search.num_nodes, float(found)
+
+def run_solver(case, solve_fn):
+    """ Return (nodes, accuracy) for solving the case with `solve_fn`. """
+    num_steps = solver.num_steps
+    _, key = solve_fn(case['crypt'], seed=0)
+    decrypted = solver.decrypt(case['crypt'], key)
+    return solver.num_steps - num_steps, get_letter_accuracy(case['plain'],
+                                                             decrypted)
+
+def run_task(task, case, timeout):
+    if task == 'matches':
+        return run_matches(case, timeout)
+    if task == 'solve':
+        return run_solver(case, solver.solve)
+    return run_solver(case, solver.solve_hybrid)
+
+def measure(task, case, timeout, trace_memory):
+    """ Return the result dict of running `task` on `case`. """
+    start = time.perf_counter()
+    nodes, accuracy = run_task(task, case, timeout)
+    wall_sec = time.perf_counter() - start
+
+    peak_kb = None
+    if trace_memory:
+        tracemalloc.start()
+        run_task(task, case, timeout)
+        peak_kb = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+
+    return {
+        'task': task,
+        'case': case['id'],
+        'bucket': case['bucket'],
+        'num_words': case['num_words'],
+        'length': case['length'],
+        'wall_sec': wall_sec,
+        'nodes': nodes,
+        'peak_kb': peak_kb,
+        'accuracy': accuracy
+    }
+
+def summarize(results):
+    """ Return a dict mapping 'task: bucket' to the medians of its results. """
+    groups = {}
+    for result in results:
+        groups.setdefault(f"{result['task']}: {result['bucket']}",
+                          []).append(result)
+    summary = {}
+    for name, group in sorted(groups.items()):
+        summary[name] = {'runs': len(group)}
+        for field in ('wall_sec', 'nodes', 'peak_kb', 'accuracy'):
+            values = [r[field] for r in group if r[field] is not None]
+            summary[name][field] = statistics.median(values) if values else None
+    return summary
+
+def compare(old, new, threshold):
+    """ Print how `new` results compare to `old`, and return the number of
+        regressions found.
+    """
+    num_regressions = 0
+    for name, new_stats in new['summary'].items():
+        old_stats = old['summary'].get(name)
+        if old_stats is None:
+            print(f'{name}: (new)')
+            continue
+        problems = []
+        for field in ('wall_sec', 'peak_kb'):
+            old_val, new_val = old_stats[field], new_stats[field]
+            if field == 'wall_sec' and new_val < MIN_COMPARED_SEC:
+                continue
+            if old_val and new_val and new_val > old_val * (1 + threshold):
+                problems.append(f'{field} {old_val:.4g} -> {new_val:.4g}')
+        if new_stats['accuracy'] < old_stats['accuracy'] - ACCURACY_DROP:
+            problems.append(f"accuracy {old_stats['accuracy']:.2f} -> "
+                            f"{new_stats['accuracy']:.2f}")
+        if problems:
+            num_regressions += 1
+            print(f'{name}: REGRESSION: ' + '; '.join(problems))
+        else:
+            print(f"{name}: ok ({old_stats['wall_sec']:.4g}s -> "
+                  f"{new_stats['wall_sec']:.4g}s)")
+    return num_regressions
+
+
+# ______________________________________________________________________
+# Main
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--per-bucket', type=int, default=N_PER_BUCKET)
+    parser.add_argument('--tasks', default=','.join(ALL_TASKS))
+    parser.add_argument('--corpus')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT_SEC)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--compare', nargs=2, metavar='RESULTS_FILE')
+    parser.add_argument('--threshold', type=float, default=SLOWDOWN_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        sys.exit(1 if compare(old, new, args.threshold) else 0)
+
+    tasks = args.tasks.split(',')
+    for task in tasks:
+        if task not in ALL_TASKS:
+            parser.error(f'unknown task: {task}')
+
+    corpus = DEFAULT_CORPUS
+    if args.corpus:
+        with open(args.corpus) as f:
+            corpus = f.read()
+    corpus = re.sub(r"[^a-zA-Z\s]", '', corpus)
+
+    # Load the dictionary and n-gram tables up front so they aren't timed.
+    matches.Matcher()
+    solver.ngrams.load_tables()
+
+    results = []
+    for case in make_cryptograms(corpus, args.seed, args.per_bucket):
+        for task in tasks:
+            result = measure(task, case, args.timeout, not args.no_memory)
+            results.append(result)
+            print(f"{task:8s} {case['id']:6s} {result['wall_sec']:8.3f}s "
+                  f"{result['nodes']:9d} nodes  "
+                  f"accuracy {result['accuracy']:.2f}")
+
+    output = {
+        'meta': {
+            'seed': args.seed,
+            'per_bucket': args.per_bucket,
+            'corpus': args.corpus,
+            'python': platform.python_version(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')
+        },
+        'results': results,
+        'summary': summarize(results)
+    }
+    with open(args.out, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'Wrote {args.out}.')
@@ -6,22 +6,46 @@
     Usage:
 
         ./cryptogram.py <cryptogram_text>
+        ./cryptogram.py --file <path> [--window N]
 
     From there you'll get a prompt until you've solved the puzzle at hand
     (which is up to you to determine).
 
     At the prompt:
 
-    > XY  --> (any two letters); Swap letters X and Y in the working solution.
+    > XY  --> (any two lowercase letters); Swap letters X and Y in the working
+              solution.
     > XX  --> (same letter twice); Toggle wheter X is highlighted as correct.
     > r   --> Retype the original cryptogram text.
     > f   --> Show letter frequency alongside English letter ranking.
+    > n   --> (with --file) Move to the next window of the text.
+    > p   --> (with --file) Move to the previous window of the text.
     > ?   --> Show help (this message).
     > s   --> Shuffle all letters randomly.
     > c   --> Show common short English words.
     > h   --> Print an abbreviated work history, for sharing your process.
+              This runs in the background while you keep working.
+    > x   --> Cancel any commands running in the background; Ctrl-C also
+              does this.
     > b   --> Toggle showing bigram frequency data.
+    > t   --> Show the likeliest dictionary words under each cipher word, given
+              the letters you've highlighted as correct.
+    > m   --> Show the letters each letter could still be, and how likely each
+              is, by narrowing every cipher word's dictionary words at once.
+    > R   --> Replay the commands saved from your last session with this
+              cryptogram.
     > q   --> Quit.
+
+    With --file, the cryptogram is read from the file at <path>, or from stdin
+    if <path> is -. This is meant for long texts: the file is read in chunks to
+    find its letter and bigram counts, and you work on a window of at most N
+    bytes (default 2000) at a time. At the prompt, n and p move to the
+    next and previous windows; the key carries across windows.
+
+    Sessions are logged to cryptogram_log.jsonl in the current directory. The
+    log is indexed by a hash of each cryptogram, so that R can seek straight to
+    a puzzle's entries. Log writes are buffered, and synced to disk every few
+    seconds, even while the prompt is idle, and on exit.
 """
 # TODO:
 #   * Currently, when printing out your history (the `h` command),
@@ -35,145 +59,249 @@
 #   * Don't count punctuation in the progress bar for the history command.
 #
 #   * Fix typos in the readme; update the example history image.
-#   * Add that pressing R will re-run all the saved commands for the given
-#     input. This fails with a message without any saved commands; if there are
-#     both current commands and saved commands, this prompts for confirmation to
-#     discard the current commands. Otherwise it re-enacts all previous
-#     commands, including those to highlight letters (not just swaps).
-#   * Add that pressing t will print out the top N words for each single cipher
-#     word, all neatly underneath the current cipher text. I could consider also
-#     printing out the most common letter mappings below that. This could act as
-#     a kind of strong hint.
 
 
 # ____________________________________________________________
 # Imports
 
+try:
+    import curses
+except ImportError:
+    curses = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import argparse
+import asyncio
+import atexit
+import codecs
+import contextlib
+import dbm
+import hashlib
+import itertools
 import json
 import math
+import os
 import random
 import re
+import shutil
+import signal
 import string
-import subprocess
 import sys
+import tempfile
+import threading
+import time
+import uuid
 
+from array import array
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import matches
+import ngrams
 
 
 # ____________________________________________________________
 # Globals and constants
 
-# These will store terminal escape codes.
-# Currently these are used by print_with_highlights().
-blue_seq  = None
-green_seq = None
-reset_seq = None
-white_seq = None
+# These will store terminal escape codes, as set by load_term_seqs().
+# Currently these are used by print_curr_str() and show_history().
+blue_seq   = None
+green_seq  = None
+gray_seq   = None
+hilite_seq = None
+reset_seq  = None
+white_seq  = None
+
+LOG_PATH       = 'cryptogram_log.jsonl'
+LOG_INDEX_PATH = 'cryptogram_log.idx'
+LOG_SYNC_SEC   = 5.0
+LOG_SIZE_KEY   = b'_log_size'  # The index key for how much of the log it covers.
+LOG_FORMAT_KEY = b'_format'    # The index key for the layout version below.
+LOG_FORMAT     = b'2'
+
+# With --file, the cryptogram is read in chunks of this many bytes, and you
+# work on windows of at most WINDOW_BYTES bytes at a time.
+READ_CHUNK_SIZE = 1 << 20
+WINDOW_BYTES    = 2000
+
+# This many heavy commands, such as h, can run in the background at once.
+N_JOB_THREADS = 2
+
+# The t command shows this many hint words under each cipher word.
+N_HINT_WORDS = 5
+
+# The m command shows up to this many plain letters for each cipher letter.
+N_MAPPING_OPTIONS = 5
+
+# This is the matches.Matcher shared by every Hints object.
+matcher      = None
+matcher_lock = threading.Lock()
+
+# show_history() writes its output in chunks of this many lines.
+HISTORY_CHUNK_LINES = 256
+
+# Lists of the codes to set each of the 256 foreground or background colors.
+fg_color_seqs = None
+bg_color_seqs = None
 
-bigram_mode = False
-en_bigram_freqs = None
+bigram_cells   = None  # bigram_cells[row][col][level] is a rendered bigram.
+en_bigram_rows = None  # These are the rendered rows of the English table.
 
 
 # ____________________________________________________________
 # Functions
 
 def log(obj):
-    log_file.write(json.dumps(obj) + '\n')
+    session_log.add(obj)
 
-def swap(s, marked_l, x, y):
-    """ Return (s', marked_l'), where x and y are swapped; if
-        x == y then x is toggled within the set marked_l).
+def get_crypt_hash(crypt):
+    """ Return the short hash of `crypt` used to index the session log. """
+    return hashlib.sha1(crypt.encode()).hexdigest()[:16]
+
+def get_state(swaps):
+    """ Return (key, marked_l) after applying all of `swaps`, which include
+        highlight toggles, to a fresh cryptogram.
+    """
+    key, marked_l = Key(), set()
+    for pair in swaps:
+        if pair[0] == pair[1]:
+            marked_l ^= {pair[0]}
+        else:
+            key.swap(pair[0], pair[1])
+    return key, marked_l
+
+def show_letter_frequencies(letter_counts, key):
+    """ Show the top 10 letters, sorted most-frequent first, given the Counter
+        `letter_counts` of characters in the cryptogram, as they read under
+        `key`.
     """
-    if x == y:
-        marked_l ^= {x}
-    s = s.replace(y, '_')
-    s = s.replace(x, y)
-    return (s.replace('_', x), marked_l)
-
-def show_letter_frequencies(s):
-    """ Show the top 10 letters in s, sorted most-frequent first. """
-    letter_counts = Counter(s.replace(' ', ''))
-    letters = [letter for letter, _ in letter_counts.most_common()[:10]]
+    letters = [
+            key.apply(letter)
+            for letter, _ in letter_counts.most_common()
+            if letter in string.ascii_lowercase
+    ][:10]
     print('Cipher letters: ', ' '.join(letters))
     print('English letters:', 'e t a o i n s r h d')
 
-def show_bigram_tables(s):
-    """ Display bigram frequency tables for s and for English. """
-
-    # Ensure the English bigram frequencies are loaded.
-    global en_bigram_freqs
-    if not en_bigram_freqs:
-        with open('data/bigram_freqs.json') as f:
-            en_bigram_freqs = json.load(f)
-
-    # Calculate bigram frequencies for the current string.
-    bigram_counts = Counter()
-    tokens = get_tokens(s)
-    for token in tokens:
-        if not is_word_token(token):
-            continue
-        for i in range(len(token) - 1):
-            bigram_counts[token[i:i+2]] += 1
-    total_bigrams = sum(bigram_counts.values())
-    bigram_freqs = {
-            bigram: count / total_bigrams
-            for bigram, count in bigram_counts.items()
-    }
-
-    # Normalize and map frequencies to the color range [232, 255].
-    max_fr = max(bigram_freqs.values(), default=1)
-    color_map = lambda freq: int(232 + freq / max_fr * 23)
-    en_max_fr = max(en_bigram_freqs.values())
-    en_color_map = lambda freq: int(232 + freq / en_max_fr * 23)
-
-    # Prepare the bigram tables.
-    color_count = Counter()
-    for row in range(26):
-        row_str = ''
-        for col in range(26):
-            bigram = chr(97 + row) + chr(97 + col)
-            # print(f'bigram={bigram}')
-            # print('raw freq:', bigram_freqs.get(bigram, 0))
-            color = color_map(bigram_freqs.get(bigram, 0))
-            # print(f'color={color}')
-            color_count[color] += 1
-            if color == 232:
-                fg_color = 232 if (row + col) % 2 == 0 else 243
-                row_str += f"\033[38;5;{fg_color}m"
-            row_str += f'\033[48;5;{color}m{bigram}\033[0m'
-        row_str += '  '
-        for col in range(26):
-            bigram = chr(97 + row) + chr(97 + col)
-            color = en_color_map(en_bigram_freqs.get(bigram, 0))
-            if color == 232:
+def get_bigram_counts(s):
+    """ Return a 26x26 list of lists whose [i][j] entry is the number of times
+        letter i is followed by letter j in the lowercase words of s.
+    """
+    counts = [[0] * 26 for _ in range(26)]
+    add_bigram_counts(counts, s)
+    return counts
+
+def add_bigram_counts(counts, s):
+    """ Add the bigrams of s into counts, as from get_bigram_counts(). """
+    for bigram, count in Counter(re.findall('(?=([a-z]{2}))', s)).items():
+        counts[ord(bigram[0]) - ord('a')][ord(bigram[1]) - ord('a')] += count
+
+def get_shown_bigram_counts(counts, key):
+    """ Return the bigram counts of a string, given its bigram counts `counts`,
+        as it reads under `key`.
+    """
+    shown_counts = [[0] * 26 for _ in range(26)]
+    idx = [ord(letter) - ord('a') for letter in key.letters]
+    for i, row in enumerate(counts):
+        shown_row = shown_counts[idx[i]]
+        for j, count in enumerate(row):
+            shown_row[idx[j]] = count
+    return shown_counts
+
+def swap_bigram_counts(counts, x, y):
+    """ Update the bigram counts of a string for swapping letters x and y in
+        it, by swapping the rows and columns for those letters.
+    """
+    i, j = ord(x) - ord('a'), ord(y) - ord('a')
+    counts[i], counts[j] = counts[j], counts[i]
+    for row in counts:
+        row[i], row[j] = row[j], row[i]
+
+def get_bigram_row(row, values, max_value):
+    """ Return the rendered row of a bigram table for the given frequencies or
+        counts, which are shaded relative to max_value.
+    """
+    cells = bigram_cells[row]
+    return ''.join([
+            cells[col][int(value / max_value * 23)]
+            for col, value in enumerate(values)
+    ])
+
+def show_bigram_tables(counts):
+    """ Display the bigram frequency table for the given bigram counts, as from
+        get_bigram_counts(), next to the one for English.
+    """
+    global bigram_cells, en_bigram_rows
+
+    # Render every bigram at each of 24 grays (232-255) once, and the English
+    # table, which never changes, once.
+    if bigram_cells is None:
+        load_term_seqs()
+        bigram_cells = [[[] for col in range(26)] for row in range(26)]
+        for row, col, level in itertools.product(range(26), range(26),
+                                                 range(24)):
+            cell = ''
+            if level == 0:
                 fg_color = 232 if (row + col) % 2 == 0 else 243
-                row_str += f"\033[38;5;{fg_color}m"
-            row_str += f'\033[48;5;{color}m{bigram}\033[0m'
-        print(row_str)
-
-def get_cmd_output(cmd):
-    """ Return stdout, as a bytes object, from running `cmd`. """
-    process_completion = subprocess.run(cmd.split(), capture_output=True)
-    return process_completion.stdout
+                cell += fg_color_seqs[fg_color]
+            cell += bg_color_seqs[232 + level] + chr(97 + row) + chr(97 + col)
+            bigram_cells[row][col].append(cell + reset_seq)
+        en_bigram_freqs = [math.exp(x) for x in ngrams.load_tables()[2]]
+        en_max_fr = max(en_bigram_freqs)
+        en_bigram_rows = [
+                get_bigram_row(row, en_bigram_freqs[26 * row:26 * (row + 1)],
+                               en_max_fr)
+                for row in range(26)
+        ]
+
+    max_count = max(map(max, counts)) or 1
+    rows = [
+            get_bigram_row(row, counts[row], max_count) + '  ' +
+            en_bigram_rows[row] + '\n'
+            for row in range(26)
+    ]
+    sys.stdout.buffer.write(''.join(rows).encode())
+    sys.stdout.flush()
 
-def print_curr_str(s, marked_l):
-    """ This expects `s` = (soln, marked_lets).
-        This prints out `soln`, highlighting the letters in marked_lets.
+def load_term_seqs():
+    """ Set the terminal escape code globals, looking them up in terminfo the
+        first time this is called. If stdout isn't a terminal, or doesn't
+        support colors, they are all set to '' so that output is plain text.
     """
-    global blue_seq, reset_seq
-
-    if blue_seq is None:
-        blue_seq  = get_cmd_output('tput setaf 33')
-        reset_seq = get_cmd_output('tput sgr0')
+    global blue_seq, white_seq, green_seq, gray_seq, hilite_seq, reset_seq
+    global fg_color_seqs, bg_color_seqs
+
+    if reset_seq is not None:
+        return
+    blue_seq = white_seq = green_seq = gray_seq = hilite_seq = reset_seq = ''
+    fg_color_seqs = bg_color_seqs = [''] * 256
+    if curses is None or not sys.stdout.isatty():
+        return
+    try:
+        curses.setupterm()
+    except curses.error:
+        return
+    setaf = curses.tigetstr('setaf')
+    setab = curses.tigetstr('setab')
+    sgr0  = curses.tigetstr('sgr0')
+    if not (setaf and setab and sgr0):
+        return
+    fg_color_seqs = [curses.tparm(setaf, i).decode() for i in range(256)]
+    bg_color_seqs = [curses.tparm(setab, i).decode() for i in range(256)]
+    blue_seq   = fg_color_seqs[33]
+    white_seq  = fg_color_seqs[7]
+    green_seq  = fg_color_seqs[118]
+    gray_seq   = fg_color_seqs[12]
+    hilite_seq = bg_color_seqs[239]
+    reset_seq  = sgr0.decode()
 
-    bytes_to_print = []
-    for c in s:
-        c_byte = c.encode()
-        if c in marked_l:
-            bytes_to_print += [blue_seq, c_byte, reset_seq]
-        else:
-            bytes_to_print.append(c_byte)
-    sys.stdout.buffer.write(b''.join(bytes_to_print + [b'\n']))
+def print_curr_str(s, marked_l):
+    """ Print out `s`, highlighting the letters in marked_l. """
+    load_term_seqs()
+    table = {ord(c): blue_seq + c + reset_seq for c in marked_l}
+    sys.stdout.buffer.write((s.translate(table) + '\n').encode())
 
 def get_tokens(s):
     """
@@ -186,37 +314,12 @@ def get_tokens(s):
 def is_word_token(s):
     return bool(re.match(r'[^\s\W]+', s))
 
-def print_with_highlights(s, white_lets, green_lets, correct_token_idx):
-    """ Print out the string `s` while highlighting characters in white or green
-        (ish) if they're in white_lets or green_lets, respectively.
-        tokens with indexes in correct_token_idx will also receive a highlighted
-        background color.
-    """
-    global white_seq, green_seq, gray_seq, hilite_seq, reset_seq
-
-    if white_seq is None:
-        white_seq  = get_cmd_output('tput setaf 7')
-        green_seq  = get_cmd_output('tput setaf 118')
-        gray_seq   = get_cmd_output('tput setaf 12')
-        hilite_seq = get_cmd_output('tput setab 239')
-        reset_seq  = get_cmd_output('tput sgr0')
-
-    bytes_to_print = []
-    for token_idx, token in enumerate(get_tokens(s)):
-        if token_idx in correct_token_idx:
-            bytes_to_print.append(hilite_seq)
-        for c in token:
-            c_byte = c.encode()
-            if c in white_lets:
-                bytes_to_print.extend([white_seq, c_byte])
-            elif c in green_lets:
-                bytes_to_print.extend([green_seq, c_byte])
-            else:
-                bytes_to_print.extend([gray_seq, c_byte])
-        bytes_to_print.append(reset_seq)
-    sys.stdout.buffer.write(b''.join(bytes_to_print))
+def is_swap(inp):
+    """ Return True iff `inp` is a two-letter swap or highlight command. """
+    return len(inp) == 2 and all(c in string.ascii_lowercase for c in inp)
 
-def print_progress_bar(perc_done):
+
+def get_progress_bar(perc_done):
     block = '█'
     half  = '▌'
     width = 30
@@ -225,38 +328,95 @@ def print_progress_bar(perc_done):
     if (n - len(s)) > 0.5:
         s += half
     s += ' ' * (width - len(s))
-    print(' |' + s + '|')
-
-def show_history(crypt, swaps, final):
-    """ Show the swap history of the cryptogram. """
-
-    good_tokens = get_tokens(final)
-    s = crypt
-
-    print(f'Start   {s}')
-
+    return ' |' + s + '|'
+
+def show_history(crypt, swaps, final, cancel=None):
+    """ Show the swap history of the cryptogram. Each line shows the text after
+        one swap, with the swapped letters in white, correct letters in green,
+        and fully correct words highlighted, followed by a progress bar.
+
+        Since swaps only change letters, the tokens of every line line up with
+        those of `crypt`, and a letter is correct in every place or none. So we
+        track correctness per cipher letter, and after each swap re-render
+        only the tokens that contain the (at most four) cipher letters whose
+        color may have changed. Lines are written in chunks, and if the
+        threading.Event `cancel` is given, we stop once it is set.
+    """
+    load_term_seqs()
+
+    # Find the tokens, and which word tokens each cipher letter appears in.
+    tokens = get_tokens(crypt)
+    tokens_of = {c: set() for c in string.ascii_lowercase}
+    word_letters = {}  # Maps word token indexes to their sets of cipher letters.
+    for i, token in enumerate(tokens):
+        if is_word_token(token):
+            word_letters[i] = set(token) & tokens_of.keys()
+            for c in word_letters[i]:
+                tokens_of[c].add(i)
+    letter_counts = Counter(c for c in crypt if c in tokens_of)
+
+    # Track which cipher letters are correct, and how many in each word aren't.
+    final_letter = {c: final[crypt.index(c)] for c in letter_counts}
+    key = Key()
+    is_correct = {c: key.letters[ord(c) - ord('a')] == final_letter.get(c)
+                  for c in string.ascii_lowercase}
+    num_wrong = {
+            i: sum(not is_correct[c] for c in letters)
+            for i, letters in word_letters.items()
+    }
+    num_correct = len(crypt) - sum(letter_counts.values()) + sum(
+            letter_counts[c] for c in letter_counts if is_correct[c])
+
+    def get_seq(c):
+        if c in white:
+            return white_seq
+        return green_seq if is_correct.get(c, True) else gray_seq
+
+    def render(i):
+        prefix = hilite_seq if num_wrong.get(i, 1) == 0 else ''
+        return prefix + tokens[i].translate(table) + reset_seq
+
+    white = set()
+    table = {ord(c): get_seq(c) + key.letters[ord(c) - ord('a')]
+             for c in string.ascii_lowercase}
+    # Everything other than a lowercase letter is always correct, and green.
+    table.update({ord(c): green_seq + c for c in set(crypt) - tokens_of.keys()})
+    rendered = [render(i) for i in range(len(tokens))]
+
+    lines = [f'Start   {crypt}\n']
     for pair in swaps:
-        s, _ = swap(s, set(), pair[0], pair[1])
-        tokens = get_tokens(s)
-
-        # Find the subset of correct tokens in `s`.
-        is_word = r'[^\s\W]+'
-        correct_token_idx = {
-                i
-                for i, token in enumerate(tokens)
-                if token == good_tokens[i] and re.match(is_word, token)
-        }
-
-        # Print the current swap.
-        print(f'{pair[0]}<->{pair[1]}   ', end='', flush=True)
-
-        # Print the current string `s`, highlighting correct letters.
-        correct_lets = {let for (i, let) in enumerate(s) if let == final[i]}
-        print_with_highlights(s, pair, correct_lets, correct_token_idx)
-
-        # Print out a progress bar of how far we've come so far.
-        perc_done = sum([let in correct_lets for let in s]) / len(s)
-        print_progress_bar(perc_done)
+        key.swap(pair[0], pair[1])
+        changed = {key.inverse[ord(x) - ord('a')] for x in pair}
+        for c in changed:
+            now_correct = key.letters[ord(c) - ord('a')] == final_letter.get(c)
+            if now_correct == is_correct[c]:
+                continue
+            is_correct[c] = now_correct
+            step = -1 if now_correct else 1
+            num_correct -= step * letter_counts[c]
+            for i in tokens_of[c]:
+                if i in num_wrong:
+                    num_wrong[i] += step
+
+        # Recolor the cipher letters that were or are now white, and re-render
+        # the tokens they appear in.
+        affected, white = white | changed, changed
+        for c in affected:
+            table[ord(c)] = get_seq(c) + key.letters[ord(c) - ord('a')]
+        for i in set().union(*(tokens_of[c] for c in affected)):
+            rendered[i] = render(i)
+
+        perc_done = num_correct / max(1, len(crypt))
+        lines.append(f'{pair[0]}<->{pair[1]}   ' + ''.join(rendered) +
+                     get_progress_bar(perc_done) + '\n')
+        if len(lines) >= HISTORY_CHUNK_LINES:
+            sys.stdout.buffer.write(''.join(lines).encode())
+            lines = []
+            if cancel and cancel.is_set():
+                lines.append('(The history was cancelled.)\n')
+                break
+    sys.stdout.buffer.write(''.join(lines).encode())
+    sys.stdout.flush()
 
 def show_in_columns(words, col_width=6, max_width=65, indent=4):
     """ Print the words in `words` in colums of width `col_width`, in lines of
@@ -314,71 +474,623 @@ def show_common_elements():
     print()
 
 
+# ____________________________________________________________
+# Classes
+
+class Key:
+    """ A permutation of the lowercase letters, mapping each cipher letter to
+        the letter it is currently shown as. Swapping two shown letters takes
+        constant time, no matter how long the text is, since we keep the
+        inverse permutation as well. Text is rendered with str.translate(),
+        and the translation table is rebuilt only after the key changes.
+    """
+
+    def __init__(self):
+        self.letters = list(string.ascii_lowercase)  # cipher -> shown
+        self.inverse = list(string.ascii_lowercase)  # shown -> cipher
+        self.table   = None
+
+    def swap(self, x, y):
+        """ Swap the shown letters x and y. """
+        i = ord(self.inverse[ord(x) - ord('a')]) - ord('a')
+        j = ord(self.inverse[ord(y) - ord('a')]) - ord('a')
+        self.letters[i], self.letters[j] = y, x
+        self.inverse[ord(x) - ord('a')] = chr(j + ord('a'))
+        self.inverse[ord(y) - ord('a')] = chr(i + ord('a'))
+        self.table = None
+
+    def copy(self):
+        key = Key()
+        key.letters = list(self.letters)
+        key.inverse = list(self.inverse)
+        return key
+
+    def apply(self, s):
+        """ Return `s` as it reads under this key. """
+        if self.table is None:
+            self.table = str.maketrans(string.ascii_lowercase,
+                                       ''.join(self.letters))
+        return s.translate(self.table)
+
+
+class Hints:
+    """ The dictionary words that fit each cipher word of a cryptogram, most
+        common first, and a matches.Propagation over them. These are found in a
+        background thread as soon as the Hints object is made, so that the
+        prompt never waits on them.
+    """
+
+    def __init__(self, crypt):
+        self.crypt       = crypt
+        # As in solver.is_dictionary_text(), only the part of a word before an
+        # apostrophe is looked up, so that "man's" is just "man".
+        self.ciphers     = re.findall(r"([a-z]+)(?:'[a-z]+)?", crypt)
+        self.domains     = {}
+        self.propagation = None
+        self.thread = threading.Thread(target=self.find_domains, daemon=True)
+        self.thread.start()
+
+    def find_domains(self):
+        global matcher
+
+        with matcher_lock:
+            if matcher is None:
+                matcher = matches.Matcher()
+        for cipher in self.ciphers:
+            if cipher not in self.domains:
+                self.domains[cipher] = matcher.get_domain(cipher)
+        ciphers = list(self.domains)
+        self.propagation = matches.Propagation(
+                ciphers, [self.domains[cipher] for cipher in ciphers])
+
+    def get_words(self, cipher, confirmed, n=N_HINT_WORDS):
+        """ Return up to n of the likeliest words for `cipher` that fit the
+            dict `confirmed`, which maps cipher letters to known plain letters.
+        """
+        plain_words, pos_masks = self.domains[cipher][:2]
+        if not plain_words:
+            return []
+        mask = (1 << len(plain_words)) - 1
+        for cipher_letter, letter in confirmed.items():
+            for pos, c in enumerate(cipher):
+                letter_mask = pos_masks[pos].get(letter, 0)
+                mask &= letter_mask if c == cipher_letter else ~letter_mask
+        words = []
+        while mask and len(words) < n:
+            low_bit = mask & -mask
+            words.append(plain_words[low_bit.bit_length() - 1])
+            mask ^= low_bit
+        return words
+
+    def show(self, key, marked_l):
+        """ Print each cipher word as it reads under `key`, with its hint words
+            in a column beneath it, wrapping to the terminal's width.
+        """
+        confirmed = {key.inverse[ord(let) - ord('a')]: let for let in marked_l}
+        ciphers = [c for c in self.ciphers if c in self.domains]
+        num_pending = len(set(self.ciphers) - self.domains.keys())
+
+        width = shutil.get_terminal_size().columns
+        lines, line_ciphers = [], []
+        for cipher in ciphers + [None]:
+            line_len = sum(len(c) + 2 for c in line_ciphers)
+            if line_ciphers and (cipher is None or
+                                 line_len + len(cipher) > width):
+                columns = [
+                        [key.apply(c)] + self.get_words(c, confirmed)
+                        for c in line_ciphers
+                ]
+                for row in range(N_HINT_WORDS + 1):
+                    lines.append('  '.join(
+                        (col[row] if row < len(col) else '').ljust(len(c))
+                        for col, c in zip(columns, line_ciphers)
+                    ).rstrip())
+                lines.append('')
+                line_ciphers = []
+            line_ciphers.append(cipher)
+
+        if num_pending:
+            lines.append(f'(Still finding words for {num_pending} more cipher '
+                         f'word{"s" if num_pending > 1 else ""}.)')
+        print('\n'.join(lines))
+
+    def show_mappings(self, key, marked_l, cancel):
+        """ Print the plain letters each letter may still stand for, given the
+            letters highlighted as correct, with how often each appears among
+            the words that still fit. This is run as a background job.
+        """
+        if self.propagation is None:
+            print('(Still finding words; try again in a moment.)')
+            return
+        confirmed = {key.inverse[ord(let) - ord('a')]: let for let in marked_l}
+        letter_counts = self.propagation.get_letter_counts(confirmed)
+        if cancel.is_set():
+            return
+        if letter_counts is None:
+            if marked_l:
+                print('No dictionary words fit the highlighted letters; or '
+                      'some word may not be in the dictionary.')
+            else:
+                print('The dictionary words don\'t all fit together; some word '
+                      'may not be in the dictionary.')
+            return
+
+        lines = ['Possible letters, with their share of fitting words:']
+        for c in sorted(letter_counts, key=lambda c: key.apply(c)):
+            counts = letter_counts[c]
+            total = sum(counts.values()) or 1
+            options = [
+                    f'{letter} {count / total:4.0%}'
+                    for letter, count in counts.most_common(N_MAPPING_OPTIONS)
+            ]
+            if len(counts) > N_MAPPING_OPTIONS:
+                options.append(f'(+{len(counts) - N_MAPPING_OPTIONS} more)')
+            lines.append(f'  {key.apply(c)}: ' + '  '.join(options))
+        print('\n'.join(lines))
+
+class CipherFile:
+    """ A long cryptogram read from a file, with its letter and bigram counts.
+        The file is read once, in chunks, to find the counts and a hash of the
+        text; after that, only a window of the text is read at a time. Text
+        from a pipe, such as stdin, is first copied to a temporary file so that
+        windows can be read from it.
+    """
+
+    def __init__(self, f, window_size=WINDOW_BYTES):
+        """ This expects `f` to be a file opened in binary mode. """
+        self.file          = f if f.seekable() else tempfile.TemporaryFile()
+        self.window_size   = window_size
+        self.letter_counts = Counter()
+        self.bigram_counts = [[0] * 26 for _ in range(26)]
+        self.starts        = [0]  # The start offsets of the windows so far.
+        self.end           = 0    # The end offset of the current window.
+
+        sha1 = hashlib.sha1()
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        last_char = ''
+        for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b''):
+            if self.file is not f:
+                self.file.write(chunk)
+            sha1.update(chunk)
+            text = decoder.decode(chunk)
+            self.letter_counts.update(text)
+            add_bigram_counts(self.bigram_counts, last_char + text)
+            last_char = text[-1:]
+        self.hash = sha1.hexdigest()[:16]
+        self.size = self.file.tell()
+
+    def read_window(self):
+        """ Return the text of the current window. Windows end after a
+            whitespace character where possible, so that words aren't split,
+            and otherwise at a character boundary.
+        """
+        start = self.starts[-1]
+        self.file.seek(start)
+        data = self.file.read(self.window_size)
+        if start + len(data) < self.size:
+            cut = max(data.rfind(b' '), data.rfind(b'\n'))
+            if cut > 0:
+                data = data[:cut + 1]
+            else:
+                # Drop the bytes of any character cut off at the end.
+                decoder = codecs.getincrementaldecoder('utf-8')('replace')
+                decoder.decode(data)
+                num_partial = len(decoder.getstate()[0])
+                if 0 < num_partial < len(data):
+                    data = data[:-num_partial]
+        self.end = start + len(data)
+        return data.decode('utf-8', 'replace')
+
+    def next_window(self):
+        """ Move to the next window, if any, and return its text. """
+        if self.end < self.size:
+            self.starts.append(self.end)
+        return self.read_window()
+
+    def prev_window(self):
+        """ Move to the previous window, if any, and return its text. """
+        if len(self.starts) > 1:
+            self.starts.pop()
+        return self.read_window()
+
+    def get_position(self):
+        return f'[Bytes {self.starts[-1]:,}-{self.end:,} of {self.size:,}]'
+
+class SessionLog:
+    """ An append-only log of session actions, with an index from the hash of
+        each cryptogram to the byte offsets of its log entries.
+
+        Each entry is a JSON line holding the action along with the session id
+        and cryptogram hash it belongs to. Entries are buffered, and written
+        and fsynced by sync(), which main() calls every LOG_SYNC_SEC seconds,
+        and at exit; the index is updated at the same time. If the log has
+        grown beyond what the index covers, perhaps by another session or an
+        older version of this script, the rest of the log is indexed first.
+
+        Several sessions may share a log. The index is only opened while
+        holding an exclusive lock on the log, and is closed before the lock
+        is released, so that no session writes back a stale copy of it. Lines
+        that aren't valid JSON, such as one torn by a crash, are skipped.
+    """
+
+    def __init__(self, path=LOG_PATH, index_path=LOG_INDEX_PATH):
+        self.path       = path
+        self.session    = uuid.uuid4().hex[:16]
+        self.crypt_hash = None
+        self.pending    = []  # These are (crypt_hash, line) pairs.
+        self.last_sync  = time.monotonic()
+        self.file       = open(path, 'ab')
+        self.index_path = index_path
+        self.index      = None  # This is the open index, while it's locked.
+        with self.locked_index():
+            self.update_index()
+
+    @contextlib.contextmanager
+    def locked_index(self):
+        """ Lock the log, and open the index as self.index, for the duration
+            of a with block.
+        """
+        if fcntl:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            with dbm.open(self.index_path, 'c') as self.index:
+                yield self.index
+        finally:
+            self.index = None
+            if fcntl:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    def update_index(self):
+        """ Index any log entries the index doesn't cover yet. This expects
+            the caller to hold locked_index().
+        """
+        size = os.path.getsize(self.path)
+        start = int(self.index.get(LOG_SIZE_KEY, b'0'))
+        if start > size or self.index.get(LOG_FORMAT_KEY) != LOG_FORMAT:
+            for key in list(self.index.keys()):
+                del self.index[key]
+            self.index[LOG_FORMAT_KEY] = LOG_FORMAT
+            start = 0
+        if start == size:
+            return
+
+        offsets = {}
+        crypt_hash = None
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    entry = {}
+                if 'crypt' in entry:
+                    crypt_hash = get_crypt_hash(entry['crypt'])
+                entry_hash = entry.get('hash', crypt_hash)
+                if entry_hash:
+                    offsets.setdefault(entry_hash, []).append(offset)
+                offset += len(line)
+        self.add_offsets(offsets, offset)
+
+    def add_offsets(self, offsets, size):
+        """ Add the given offsets, a dict mapping crypt hashes to lists of
+            offsets, to the index, which then covers `size` bytes of the log.
+            This expects the caller to hold locked_index().
+
+            Each crypt hash's offsets are stored in parts, under the keys
+            "<hash>:0", "<hash>:1", and so on, with the number of parts under
+            the hash itself. Each sync adds a part rather than rewriting all of
+            a hash's offsets, since dbm.dumb appends every larger value to its
+            data file, which would then grow quadratically.
+        """
+        for crypt_hash, hash_offsets in offsets.items():
+            key = crypt_hash.encode()
+            num_parts = int(self.index.get(key, b'0'))
+            self.index[key + b':%d' % num_parts] = array(
+                    'q', hash_offsets).tobytes()
+            self.index[key] = b'%d' % (num_parts + 1)
+        self.index[LOG_SIZE_KEY] = str(size).encode()
+        if hasattr(self.index, 'sync'):
+            self.index.sync()
+
+    def add(self, obj):
+        """ Log the action `obj`. An 'init' or 'replace' action starts
+            logging for the cryptogram obj['crypt'], or for the one with hash
+            obj['hash'] if the cryptogram is too long to log.
+        """
+        if 'crypt' in obj:
+            self.crypt_hash = get_crypt_hash(obj['crypt'])
+        elif 'hash' in obj:
+            self.crypt_hash = obj['hash']
+        entry = dict(obj, session=self.session, hash=self.crypt_hash)
+        self.pending.append((self.crypt_hash, json.dumps(entry) + '\n'))
+        if time.monotonic() - self.last_sync >= LOG_SYNC_SEC:
+            self.sync()
+
+    def sync(self):
+        """ Write and fsync all pending entries, and index them. """
+        self.last_sync = time.monotonic()
+        if not self.pending:
+            return
+        with self.locked_index():
+            self.update_index()  # In case another session has written entries.
+            offset = self.file.seek(0, os.SEEK_END)
+            # If the log ends in a torn line, start our entries on a new one.
+            if offset > 0:
+                with open(self.path, 'rb') as f:
+                    f.seek(offset - 1)
+                    if f.read(1) != b'\n':
+                        offset += self.file.write(b'\n')
+            offsets = {}
+            for crypt_hash, line in self.pending:
+                offsets.setdefault(crypt_hash, []).append(offset)
+                offset += self.file.write(line.encode())
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending = []
+            self.add_offsets(offsets, offset)
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    def get_saved_swaps(self, crypt_hash):
+        """ Return the swaps, including highlight toggles, that give the final
+            state of the latest earlier session with the cryptogram whose hash
+            is `crypt_hash` that made any; or return None if there is no such
+            session.
+        """
+        key = crypt_hash.encode()
+        offsets = array('q')
+        with self.locked_index():
+            for part in range(int(self.index.get(key, b'0'))):
+                offsets.frombytes(self.index[key + b':%d' % part])
+        sessions = {}  # This maps session ids to their entries, latest first.
+        with open(self.path, 'rb') as f:
+            for offset in reversed(offsets):
+                f.seek(offset)
+                try:
+                    entry = json.loads(f.readline())
+                except ValueError:
+                    continue
+                if not isinstance(entry, dict) or 'action' not in entry:
+                    continue
+                session = entry.get('session', key)
+                if session != self.session:
+                    sessions.setdefault(session, []).append(entry)
+
+        for entries in sessions.values():
+            swaps = []
+            for entry in reversed(entries):
+                if entry['action'] == 'swap':
+                    swaps.append(entry['letters'])
+                elif entry['action'] == 'init':
+                    swaps = []
+                else:  # This is a shuffle, replay, or replacement.
+                    swaps = list(entry.get('swaps', []))
+            if swaps:
+                return swaps
+        return None
+
+
 # ____________________________________________________________
 # Main
 
-if len(sys.argv) < 2:
-    print(__doc__)
-    sys.exit(0)
+async def ainput(prompt):
+    """ Return a line of input, read in a thread so the event loop runs on. """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(input_executor, input, prompt)
+
+def start_job(func, *args):
+    """ Run func(*args, cancel) in the background, where `cancel` is a
+        threading.Event that asks func to stop early.
+    """
+    cancel = threading.Event()
+    future = asyncio.get_running_loop().run_in_executor(job_executor, func,
+                                                        *args, cancel)
+    jobs[future] = cancel
+    future.add_done_callback(lambda future: jobs.pop(future, None))
+
+async def sync_log():
+    """ Sync the session log every LOG_SYNC_SEC seconds, so that entries are
+        saved even while the prompt is idle.
+    """
+    while True:
+        await asyncio.sleep(LOG_SYNC_SEC)
+        session_log.sync()
+
+def cancel_jobs():
+    """ Ask every background job to stop, and return how many there were. """
+    for cancel in jobs.values():
+        cancel.set()
+    return len(jobs)
+
+def on_interrupt():
+    if cancel_jobs():
+        print('\nCancelled the background commands.')
+    else:
+        print('\n(Nothing to cancel; use q or Ctrl-D to quit.)')
+
+async def main(crypt, cipher_file=None):
+    """ Run the prompt for the cryptogram `crypt`; or, if `cipher_file` is
+        given, for the CipherFile's text, a window at a time.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGINT, on_interrupt)
+    except NotImplementedError:
+        pass
+    sync_task = asyncio.create_task(sync_log())
+
+    # The letter and bigram counts are those of the whole cryptogram, while
+    # crypt and curr_str hold only the current window of a CipherFile.
+    if cipher_file:
+        crypt         = cipher_file.read_window()
+        crypt_hash    = cipher_file.hash
+        letter_counts = cipher_file.letter_counts
+        cipher_counts = cipher_file.bigram_counts
+        log({'action': 'init', 'hash': crypt_hash})
+        print(cipher_file.get_position())
+    else:
+        crypt_hash    = get_crypt_hash(crypt)
+        letter_counts = Counter(crypt)
+        cipher_counts = get_bigram_counts(crypt)
+        log({'action': 'init', 'crypt': crypt})
+
+    swaps    = []
+    key      = Key()
+    curr_str = crypt
+    marked_l = set()
+
+    # These are the bigram counts as the cryptogram reads under the current
+    # key, kept up to date as letters are swapped.
+    bigram_counts = get_shown_bigram_counts(cipher_counts, key)
+    bigram_mode   = False
+
+    hints = Hints(crypt)
+
+    while True:
+
+        try:
+            inp = await ainput('> ')
+        except EOFError:
+            print('Have a great rest of your day! :)')
+            break
+
+        if inp == 'r' and cipher_file:
+            print('The cryptogram can only be replaced without --file.')
+
+        elif inp == 'r':
+            print(f'Original cryptogram:\n{crypt}')
+            crypt = await ainput('Replacement cryptogram: ')
+            log({'action': 'replace', 'crypt': crypt, 'swaps': swaps})
+            crypt_hash    = get_crypt_hash(crypt)
+            letter_counts = Counter(crypt)
+            cipher_counts = get_bigram_counts(crypt)
+            curr_str = key.apply(crypt)
+            bigram_counts = get_shown_bigram_counts(cipher_counts, key)
+            hints = Hints(crypt)
+
+        elif inp in ('n', 'p') and cipher_file:
+            if inp == 'n':
+                crypt = cipher_file.next_window()
+            else:
+                crypt = cipher_file.prev_window()
+            curr_str = key.apply(crypt)
+            hints = Hints(crypt)
+            print(cipher_file.get_position())
+
+        elif inp == 'f':
+            show_letter_frequencies(letter_counts, key)
+
+        elif inp == 'b':
+            bigram_mode = not bigram_mode
+            print(f"Bigram mode {'on' if bigram_mode else 'off'}.")
+
+        elif inp == '?':
+            print(__doc__)
+
+        elif inp == 's':
+            # Replace the key with a random one, built as a Fisher-Yates
+            # shuffle so that it is also a list of swaps for the history.
+            swaps, key = [], Key()
+            for i in range(25, 0, -1):
+                j = random.randint(0, i)
+                if j != i:
+                    swaps.append(chr(i + ord('a')) + chr(j + ord('a')))
+                    key.swap(swaps[-1][0], swaps[-1][1])
+            curr_str, marked_l = key.apply(crypt), set()  # No marked letters.
+            bigram_counts = get_shown_bigram_counts(cipher_counts, key)
+            log({'action': 'shuffle', 'swaps': swaps})
+
+        elif inp == 'R':
+            saved_swaps = session_log.get_saved_swaps(crypt_hash)
+            if saved_swaps is None:
+                print('There are no saved commands for this cryptogram.')
+                continue
+            if swaps:
+                answer = await ainput('Discard your current commands? [y/N] ')
+                if answer != 'y':
+                    print('Ok, nothing was replayed.')
+                    continue
+            swaps = saved_swaps
+            key, marked_l = get_state(swaps)
+            curr_str = key.apply(crypt)
+            bigram_counts = get_shown_bigram_counts(cipher_counts, key)
+            log({'action': 'replay', 'swaps': swaps})
+
+        elif inp == 'c':
+            show_common_elements()
+
+        elif inp == 't':
+            hints.show(key, marked_l)
+
+        elif inp == 'm':
+            start_job(hints.show_mappings, key.copy(), set(marked_l))
+            continue
+
+        elif inp == 'h':
+            start_job(show_history, crypt, list(swaps), curr_str)
+            continue
 
-log_file = open('cryptogram_log.jsonl', 'a')
-crypt    = ' '.join(sys.argv[1:])
-swaps    = []
-curr_str = crypt
-marked_l = set()
+        elif inp == 'x':
+            print(f'Cancelled {cancel_jobs()} background command(s).')
+            continue
+
+        elif inp == 'q':
+            print('Have a great day! :D')
+            break
+
+        elif is_swap(inp):
+            swaps.append(inp)
+            log({'action': 'swap', 'letters': inp})
+            if inp[0] == inp[1]:
+                marked_l ^= {inp[0]}
+            else:
+                key.swap(inp[0], inp[1])
+                curr_str = key.apply(crypt)
+                swap_bigram_counts(bigram_counts, inp[0], inp[1])
+
+        print_curr_str(curr_str, marked_l)
 
-log({'action': 'init', 'crypt': crypt})
+        if bigram_mode:
+            show_bigram_tables(bigram_counts)
 
-while True:
+    sync_task.cancel()
+    cancel_jobs()
+
+
+parser = argparse.ArgumentParser(usage=__doc__)
+parser.add_argument('--file')
+parser.add_argument('--window', type=int, default=WINDOW_BYTES)
+parser.add_argument('crypt', nargs='*')
+args = parser.parse_args()
+
+if not args.crypt and not args.file:
+    print(__doc__)
+    sys.exit(0)
+if args.window < 1:
+    parser.error('--window must be at least 1.')
 
+cipher_file = None
+if args.file == '-':
+    cipher_file = CipherFile(sys.stdin.buffer, args.window)
+    # The prompt needs a new stdin now that we've read all of this one.
     try:
-        inp = input('> ')
-    except (EOFError, KeyboardInterrupt):
-        print('Have a great rest of your day! :)')
-        sys.exit(0)
-
-    if inp == 'r':
-        print(f'Original cryptogram:\n{crypt}')
-        curr_str = crypt = input('Replacement cryptogram: ')
-        log({'action': 'replace', 'crypt': crypt})
-        for pair in swaps:
-            curr_str, marked_l = swap(curr_str, marked_l, pair[0], pair[1])
-
-    elif inp == 'f':
-        show_letter_frequencies(curr_str)
-
-    elif inp == 'b':
-        bigram_mode = not bigram_mode
-        print(f"Bigram mode {'on' if bigram_mode else 'off'}.")
-
-    elif inp == '?':
-        print(__doc__)
-
-    elif inp == 's':
-        # Replace swaps with random swaps, one for each letter.
-        swaps = [(i, random.choice(range(26))) for i in range(26)]
-        swaps = [(chr(i + ord('a')), chr(j + ord('a'))) for i, j in swaps]
-        soln = (crypt, set())
-        for pair in swaps:
-            soln = swap(soln, pair[0], pair[1])
-        curr_str, marked_l = soln[0], set()  # No marked letters.
-
-    elif inp == 'c':
-        show_common_elements()
-
-    elif inp == 'h':
-        show_history(crypt, swaps, curr_str)
-
-    elif inp == 'q':
-        print('Have a great day! :D')
-        sys.exit(0)
-        
-    elif len(inp) == 2:
-        swaps.append(inp)
-        log({'action': 'swap', 'letters': inp})
-        curr_str, marked_l = swap(curr_str, marked_l, inp[0], inp[1])
-
-    print_curr_str(curr_str, marked_l)
-
-    if bigram_mode:
-        show_bigram_tables(curr_str)
+        sys.stdin = open('/dev/tty')
+    except OSError:
+        print('With --file -, the prompt needs a terminal to read from.')
+        sys.exit(1)
+elif args.file:
+    cipher_file = CipherFile(open(args.file, 'rb'), args.window)
+
+session_log = SessionLog()
+atexit.register(session_log.close)
+
+# Input is read on its own thread, since it's usually blocked waiting for the
+# user. Heavy commands run as jobs on the other threads.
+input_executor = ThreadPoolExecutor(1)
+job_executor   = ThreadPoolExecutor(N_JOB_THREADS)
+jobs           = {}  # This maps the future of each job to its cancel Event.
+
+asyncio.run(main(' '.join(args.crypt), cipher_file))
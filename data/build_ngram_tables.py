@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# coding: utf-8
+""" build_ngram_tables.py
+
+    Usage:
+        ./build_ngram_tables.py [--jobs N] [--max-n N] [--word-counts FILE]
+                                <plain_text_file.txt> [more_files.txt ...]
+
+    This produces the n-gram table files ngrams2.bin, ngrams3.bin, ..., up to
+    ngrams<max-n>.bin (by default, up to quadgrams) in this directory, as
+    loaded by ngrams.py. Each table holds the log-probabilities of the
+    lowercase-only letter n-grams within words of the given source texts.
+
+    The source files are streamed in chunks, which are counted by a pool of N
+    worker processes (by default, one per CPU), so the texts may be far larger
+    than memory. As in find_bigram_freqs.py, non-ASCII characters are dropped
+    and text is lowercased before counting.
+
+    With --word-counts FILE, this also writes FILE with one "word count" line
+    per distinct word, most common first. If FILE is data/word_counts.txt,
+    matches.py uses these counts to rank dictionary words by frequency.
+"""
+
+
+# ______________________________________________________________________
+# Imports
+
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ngrams
+
+
+# ______________________________________________________________________
+# Globals and constants
+
+CHUNK_SIZE = 8 << 20
+
+# In a worker process, this is (max_n, count_words).
+pool_args = None
+
+
+# ______________________________________________________________________
+# Functions
+
+def read_chunks(filenames):
+    """ Yield the text of the given files in chunks of about CHUNK_SIZE bytes,
+        each ending on whitespace so that no word is split between chunks.
+    """
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            tail = b''
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                chunk = tail + chunk
+                cut = max(chunk.rfind(b' '), chunk.rfind(b'\n')) + 1
+                if cut == 0:
+                    tail = chunk
+                    continue
+                tail = chunk[cut:]
+                yield chunk[:cut]
+            if tail:
+                yield tail
+
+def init_worker(max_n, count_words):
+    global pool_args
+    pool_args = (max_n, count_words)
+
+def count_chunk(chunk):
+    """ Return (ngram_counts, word_counts) for the bytes `chunk`, where
+        ngram_counts maps each n to a Counter of n-grams, and word_counts is a
+        Counter of words, or None if we aren't counting words.
+
+        Every n-gram lies within a word, so we count the distinct words first,
+        without listing them, and then slide over each distinct word once.
+        This keeps memory use to about the size of the chunk's vocabulary.
+    """
+    max_n, count_words = pool_args
+    text = chunk.decode('ascii', 'ignore').lower()
+    words = Counter(m.group() for m in re.finditer('[a-z]+', text))
+    ngram_counts = {n: Counter() for n in range(2, max_n + 1)}
+    for word, count in words.items():
+        for n, counts in ngram_counts.items():
+            for i in range(len(word) - n + 1):
+                counts[word[i:i + n]] += count
+    return ngram_counts, (words if count_words else None)
+
+
+# ______________________________________________________________________
+# Main
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count())
+    parser.add_argument('--max-n', type=int, default=ngrams.MAX_N)
+    parser.add_argument('--word-counts')
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    if not 2 <= args.max_n <= ngrams.MAX_N:
+        parser.error(f'--max-n must be between 2 and {ngrams.MAX_N}.')
+
+    ngram_counts = {n: Counter() for n in range(2, args.max_n + 1)}
+    word_counts = Counter()
+    initargs = (args.max_n, bool(args.word_counts))
+    with multiprocessing.Pool(args.jobs, init_worker, initargs) as pool:
+        results = pool.imap_unordered(count_chunk, read_chunks(args.files))
+        for chunk_ngram_counts, chunk_word_counts in results:
+            for n, counts in chunk_ngram_counts.items():
+                ngram_counts[n].update(counts)
+            if chunk_word_counts:
+                word_counts.update(chunk_word_counts)
+
+    for n, counts in ngram_counts.items():
+        total = sum(counts.values())
+        if total == 0:
+            print(f'No {n}-grams were found; no table was written.')
+            continue
+        freqs = {ngram: count / total for ngram, count in counts.items()}
+        path = ngrams.get_table_path(n)
+        ngrams.write_table(path, n, ngrams.make_table(n, freqs))
+        print(f'Wrote {path} from {total:,} {n}-grams.')
+
+    if args.word_counts:
+        with open(args.word_counts, 'w') as f:
+            for word, count in word_counts.most_common():
+                f.write(f'{word} {count}\n')
+        print(f'Wrote {args.word_counts} with {len(word_counts):,} words.')
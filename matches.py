@@ -5,25 +5,128 @@
 
     Usage:
 
-        ./matches.py cipher_word [ciper_word*]
+        ./matches.py [--jobs N] [--best] [--max-results N] [--timeout SECS]
+                     cipher_word [ciper_word*]
+        ./matches.py --serve socket_path [--workers N] [--timeout SECS]
+        ./matches.py --batch queries.jsonl [--jobs N] [--timeout SECS]
 
     This searches for possible decodings of the given cipher words. It assumes
     that all words must be simultaneously deciphered. It attempts to provide the
-    most likely plaintext translations first.
+    most likely plaintext translations first, and stops after --max-results of
+    them (by default, 300, or 10 with --best) or after --timeout seconds, if
+    given.
+
+    Each dictionary word has a cost, which is -log of its frequency in a text
+    corpus; the cost of a translation is the sum of the costs of its words. The
+    word frequencies are read from data/word_counts.txt, which has one "word
+    count" line per word, as written by data/build_ngram_tables.py with
+    --word-counts. Words that are missing from that file, or all words if there
+    is no such file, are given a Zipf's law cost from their place in the word
+    lists in data/, which are roughly in order of frequency.
 
     Lowercase letters may be matched to anything except letters already matched
     to different lowercase letters (for example, abbcd will match "moose" but
     not "geese").
 
     Uppercase letters will strictly match exactly that letter.
+
+    By default, translations are listed in order of the highest rank of their
+    words, where a word's rank is its place among the words of its letter
+    pattern, cheapest first. With --best, the lowest-cost translations are
+    listed instead, with their costs. These are found by a branch-and-bound
+    search, which skips every partial translation whose cost, plus the least
+    possible cost of the words it leaves undecoded, is no better than the worst
+    of the best matches found so far. The least possible cost of the undecoded
+    words is found by pairing them up, and charging each pair for its cheapest
+    two candidates that don't need the same plain letters. Words that compete
+    for plain letters across pairs are still not charged for it, so --best can
+    be much slower on many cipher words that share few letters; with
+    --timeout, it then lists the best matches it found in time.
+
+    With --jobs N, the search is split across N worker processes. Each worker
+    searches its own share of candidate words for a single cipher word, and
+    the matches are merged back in the same order a single process would use.
+
+    With --serve, this runs as a long-lived server that keeps the dictionary
+    loaded and answers queries over a Unix domain socket. Each query is one line
+    of JSON, and each answer is one line of JSON:
+
+        {"ciphers": ["xyzzy", "abc"], "limit": 10, "timeout": 0.5}
+        {"matches": [{"max_rank": 0, "words": [...], "mapping": {...}}, ...],
+         "timed_out": false}
+
+    Both "limit" and "timeout" are optional, and are capped by --max-results
+    and --timeout. Up to --workers queries are answered at once. A query may
+    also be a bare list of cipher words, and any "id" it has is echoed back.
+
+    With --cache FILE, the candidate cache (see below) is loaded from FILE at
+    startup if it exists, and saved back to FILE on exit. With --stats, cache
+    hit and miss counts are printed to stderr on exit; a server also answers
+    the query {"stats": true} with these counts.
+
+    With --batch, queries are read in the same format from the given file (or
+    from stdin, if the file is -), and their answers are written in order to
+    stdout as JSON lines. The whole batch shares one loaded dictionary and one
+    candidate cache; with --jobs N, N queries are answered at a time by forked
+    workers. Each worker then has its own copy of the cache, and the entries
+    they add, with their hit and miss counts, are merged back for --cache and
+    --stats.
+
+    This can also be imported, to search in-process without reloading the
+    dictionary for each query:
+
+        from matches import Matcher
+        matcher = Matcher()
+        for max_rank, words, mapping in matcher.iter_matches(['xyzzy', 'abc']):
+            ...
+        matches, timed_out = matcher.best_matches(['xyzzy', 'abc'], 10)
+        for cost, words, mapping in matches:
+            ...
+
+    Here iter_matches() streams every match in order of the highest rank of
+    its words, where a word's rank is its place among the words of its letter
+    pattern, cheapest first; best_matches() returns the 10 lowest-cost ones.
+
+    A Propagation, made from the same candidates, finds the plain letters each
+    cipher letter may still map to without listing every match:
+
+        propagation = Propagation(ciphers, map(matcher.get_domain, ciphers))
+        letter_counts = propagation.get_letter_counts({'x': 'e'})
+
+    Each cipher word's candidates depend only on its letter pattern and its
+    uppercase letters, so they are kept in an LRU cache keyed by those. For
+    example, "xyz" and "abc" share an entry, as do "ABcd" and "ABxy".
+
+    The word lists and counts in data/ are compiled into the binary file
+    data/dictionary.idx the first time this is run, and again whenever they
+    change. Later runs memory-map that file instead of parsing the word lists.
 """
 
 
 # ____________________________________________________________
 # Imports
 
+import argparse
+import hashlib
+import heapq
+import itertools
+import math
+import mmap
+import multiprocessing
+import json
+import os
+import pickle
+import socket
+import socketserver
+import stat
+import string
+import struct
 import sys
-from collections import defaultdict
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 
 
@@ -32,163 +135,1292 @@ from glob import glob
 
 N_MATCHES_TO_SHOW = 300
 
+# This is the default number of matches to show with --best. Each one raises
+# the bar that a partial decrypt must clear to be pruned, so this is small.
+N_BEST_MATCHES_TO_SHOW = 10
+
+# This is the default bound on the total number of candidate words held in a
+# Matcher's candidate cache.
+MAX_CACHED_WORDS = 2_000_000
+
+# This is how many sets of fixed letters a Propagation keeps the state of.
+N_CACHED_STATES = 64
+
+# With --jobs N, at most this many seeds per worker are searched ahead of the
+# matches being consumed.
+MAX_SEEDS_AHEAD = 2
+
+# These are the server's defaults for --workers and --timeout.
+N_SERVER_WORKERS   = 4
+SERVER_TIMEOUT_SEC = 5.0
+
+DATA_DIR         = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'data')
+INDEX_PATH       = os.path.join(DATA_DIR, 'dictionary.idx')
+WORD_COUNTS_PATH = os.path.join(DATA_DIR, 'word_counts.txt')
+
+# The dictionary index file is laid out as:
+#   * A header (INDEX_HEADER), including a signature of the source word lists.
+#   * A length table; entry n is (first_entry, num_entries) for the patterns of
+#     length n, so that each length's entries form a contiguous, sorted array.
+#   * The pattern entries, each (pattern_offset, words_offset, costs_offset,
+#     num_words), sorted by (length, pattern).
+#   * A pool. Each pattern is followed by its words, in rank order (cheapest
+#     first) and without separators; all of these words have the pattern's
+#     length. Then come the words' costs, as little-endian float32 values.
+INDEX_MAGIC   = b'CRYPTIDX'
+INDEX_VERSION = 2
+INDEX_HEADER  = struct.Struct('<8sI20sII')  # magic, version, sig, max_len, n
+LENGTH_ENTRY  = struct.Struct('<II')
+PATTERN_ENTRY = struct.Struct('<IIII')
+
+index = None  # This is set by load_dictionary().
+
+# In a worker process of Search.find_matches() or find_best_matches(), this is
+# the Search object that the worker is helping with; in a worker process of
+# answer_batch(), this is the Matcher that answers the worker's queries.
+pool_search  = None
+pool_matcher = None
+
 
 # ____________________________________________________________
 # Functions
 
-def is_match(cipher, word, num_cipher_letters, n):
-    if len(word) != len(cipher):
-        return False
-    num_word_letters = len(set(list(word)))
-    if num_word_letters != num_cipher_letters:
-        return False
-    for i in range(n):
-        if cipher[i].isupper() and cipher[i].lower() != word[i]:
+def get_pattern(word):
+    """ Return the canonical letter pattern of `word`; eg, "moose" -> "abbcd".
+        Characters are compared exactly, so "Aa" has the pattern "ab".
+    """
+    letters = {}
+    return ''.join([
+        letters.setdefault(c, chr(ord('a') + len(letters)))
+        for c in word
+    ])
+
+def fits_fixed_letters(cipher, word):
+    """ Return True iff every uppercase letter in `cipher` matches `word`. """
+    for cipher_letter, plain_letter in zip(cipher, word):
+        if cipher_letter.isupper() and cipher_letter.lower() != plain_letter:
             return False
-        for j in range(i, n):
-            if cipher[i] == cipher[j] and word[i] != word[j]:
-                return False
     return True
 
-# This expects two dicts, and a cipher/plain_word pair.
-# The `decoder` maps cipher letters to plain letters.
-# The `encoder` maps plain letters to cipher letters.
-# If the cipher->plain_word map is compatible with the encoder/decoder,
-# they are modified and this returns True.
-# Otherwise, this returns False.
-def did_update_map(decoder, encoder, cipher, plain_word):
-
-    # This implementation is a little verbose, but I found it to be a bit faster
-    # than a smaller version that relies on setdefault calls.
-
-    for i in range(len(cipher)):
-        cipher_letter = cipher[i]
-        plain_letter  = plain_word[i]
+def get_candidates(cipher):
+    """ Return (plain_words, costs) for the dictionary words that `cipher` may
+        decode to, in rank order, where costs[k] is the cost of plain_words[k].
+        A word is a candidate when it has the same letter pattern as `cipher`
+        and agrees with all of its uppercase (fixed) letters.
+    """
+    pattern = get_pattern(cipher)
+    pattern_words = get_pattern_words(pattern)
+    pattern_costs = get_pattern_costs(pattern)
+    if cipher.islower():
+        return pattern_words, pattern_costs
+    keep = [fits_fixed_letters(cipher, w) for w in pattern_words]
+    return (list(itertools.compress(pattern_words, keep)),
+            list(itertools.compress(pattern_costs, keep)))
 
-        if cipher_letter in decoder:
-            if decoder[cipher_letter] != plain_letter:
-                return False
-        else:
-            decoder[cipher_letter] = plain_letter
+def get_cache_key(cipher):
+    """ Return the key of `cipher` in a CandidateCache; this is `cipher` with
+        its lowercase letters renamed in order of appearance, so that "xyz"
+        and "abc" both become "abc", and "ABcd" becomes "ABab".
+    """
+    letters = {}
+    return ''.join([
+        c if c.isupper() else letters.setdefault(c, chr(ord('a') + len(letters)))
+        for c in cipher
+    ])
 
-        if plain_letter in encoder:
-            if encoder[plain_letter] != cipher_letter:
-                return False
-        else:
-            encoder[plain_letter] = cipher_letter
+def get_masks(word_list):
+    """ Return (pos_masks, any_masks) for the words in `word_list`.
 
-    return True
+        Each mask is an int used as a bitset over indexes into `word_list`.
+        pos_masks[pos][letter] has bit k set iff word_list[k][pos] == letter;
+        any_masks[letter] has bit k set iff letter appears in word_list[k].
+    """
+    n = len(word_list[0]) if word_list else 0
+    num_bytes = len(word_list) // 8 + 1
+    pos_bits = [defaultdict(lambda: bytearray(num_bytes)) for _ in range(n)]
+    for k, word in enumerate(word_list):
+        byte_idx, bit = k >> 3, 1 << (k & 7)
+        for pos, letter in enumerate(word):
+            pos_bits[pos][letter][byte_idx] |= bit
+    pos_masks = [
+            {
+                letter: int.from_bytes(bits, 'little')
+                for letter, bits in letter_bits.items()
+            }
+            for letter_bits in pos_bits
+    ]
+    any_masks = defaultdict(int)
+    for letter_masks in pos_masks:
+        for letter, mask in letter_masks.items():
+            any_masks[letter] |= mask
+    return pos_masks, dict(any_masks)
 
-def load_dictionary():
+def get_sources_signature(sources):
+    """ Return a 20-byte digest that changes whenever any source file does. """
+    digest = hashlib.sha1()
+    for fname in sources:
+        stat = os.stat(fname)
+        digest.update(f'{os.path.basename(fname)} {stat.st_size} '
+                      f'{stat.st_mtime_ns}\n'.encode())
+    return digest.digest()
 
-    global words
+def get_word_costs(sources, counts_path=None):
+    """ Return a dict mapping each word in the word lists `sources` to its
+        cost.
 
-    words = defaultdict(list)  # This maps n to the words of length n.
-    for fname in glob('data/*'):
-        if fname.endswith('.json') or fname.endswith('.py'):
-            continue
+        A word with a count in the file `counts_path` costs log(total / count),
+        where total is the sum of all the counts there. Any other word costs
+        log(total) + log(1 + r), where r is its place in its word list; this is
+        how Zipf's law would score it if it were less common than every counted
+        word. The counts file is streamed, and only the counts of dictionary
+        words are kept.
+    """
+    ranks = {}
+    for fname in sources:
         with open(fname) as f:
+            r = 0
             for word in f:
                 w = word.lower().strip()
-                words[len(w)].append(w)
+                if w and w not in ranks:
+                    ranks[w] = r
+                    r += 1
+
+    counts = {}
+    total = 1
+    if counts_path:
+        total = 0
+        with open(counts_path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) != 2 or not fields[1].isdigit():
+                    continue
+                count = int(fields[1])
+                total += count
+                if fields[0] in ranks and count > 0:
+                    counts[fields[0]] = count
+        total = max(total, 1)
+
+    log_total = math.log(total)
+    return {
+            w: log_total - math.log(counts[w]) if w in counts
+               else log_total + math.log(1 + r)
+            for w, r in ranks.items()
+    }
+
+def build_index(sources, signature, counts_path=None):
+    """ Compile the word lists in `sources`, with word costs from the counts
+        file `counts_path` (see get_word_costs()), into the bytes of an index
+        file.
+    """
+
+    costs = get_word_costs(sources, counts_path)
+    words_by_pattern = defaultdict(list)
+    for w in costs:
+        words_by_pattern[get_pattern(w)].append(w)
+    for pattern_words in words_by_pattern.values():
+        pattern_words.sort(key=costs.get)
 
-def itoa(i):
-    """ Return a length-3 string version of i, expected to be in [0, 1000). """
-    return f'{i:3d}'
+    patterns = sorted(words_by_pattern, key=lambda p: (len(p), p))
+    max_len  = len(patterns[-1]) if patterns else 0
+
+    length_table = [[0, 0] for _ in range(max_len + 1)]
+    entries = bytearray()
+    pool    = bytearray()
+    for entry_idx, pattern in enumerate(patterns):
+        n = len(pattern)
+        if length_table[n][1] == 0:
+            length_table[n][0] = entry_idx
+        length_table[n][1] += 1
+        pattern_offset = len(pool)
+        pool += pattern.encode()
+        pattern_words = words_by_pattern[pattern]
+        words_offset = len(pool)
+        pool += ''.join(pattern_words).encode()
+        entries += PATTERN_ENTRY.pack(pattern_offset, words_offset, len(pool),
+                                      len(pattern_words))
+        pool += struct.pack(f'<{len(pattern_words)}f',
+                            *[costs[w] for w in pattern_words])
+
+    header = INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, signature, max_len,
+                               len(patterns))
+    lengths = b''.join(LENGTH_ENTRY.pack(*entry) for entry in length_table)
+    return header + lengths + entries + pool
+
+def load_dictionary():
+    """ Memory-map the dictionary index, first rebuilding it if it is missing
+        or out of date with respect to the word lists in DATA_DIR.
+    """
+    global index, index_signature, index_max_len, index_num_entries
+
+    sources     = sorted(glob(os.path.join(DATA_DIR, 'words*')))
+    counts_path = None
+    if os.path.exists(WORD_COUNTS_PATH):
+        counts_path = WORD_COUNTS_PATH
+        sources.append(counts_path)
+    signature = get_sources_signature(sources)
+    if counts_path:
+        sources.pop()
+
+    index = None
+    try:
+        with open(INDEX_PATH, 'rb') as f:
+            index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_sig, _, _ = INDEX_HEADER.unpack_from(index)
+        if (magic, version, index_sig) != (INDEX_MAGIC, INDEX_VERSION,
+                                           signature):
+            index = None
+    except (OSError, ValueError, struct.error):
+        index = None
+
+    if index is None:
+        index = build_index(sources, signature, counts_path)
+        # Write the index atomically so that concurrent runs never see a
+        # partial file. If DATA_DIR is read-only, we use the index in memory.
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(index)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, INDEX_PATH)
+        except OSError:
+            pass
+
+    header = INDEX_HEADER.unpack_from(index)
+    _, _, index_signature, index_max_len, index_num_entries = header
+
+def find_pattern_entry(pattern):
+    """ Return (words_start, costs_start, num_words) for the given pattern,
+        where the starts are offsets into the index; or None if no dictionary
+        word has this pattern.
+    """
+
+    n = len(pattern)
+    if n == 0 or n > index_max_len:
+        return None
+
+    lengths_offset = INDEX_HEADER.size
+    entries_offset = lengths_offset + LENGTH_ENTRY.size * (index_max_len + 1)
+    pool_offset    = entries_offset + PATTERN_ENTRY.size * index_num_entries
+
+    # Binary search over the sorted, fixed-width patterns of length n.
+    key = pattern.encode()
+    lo, num_entries = LENGTH_ENTRY.unpack_from(index, lengths_offset +
+                                               LENGTH_ENTRY.size * n)
+    hi = lo + num_entries
+    while lo < hi:
+        mid = (lo + hi) // 2
+        pattern_offset, words_offset, costs_offset, num_words = \
+                PATTERN_ENTRY.unpack_from(index, entries_offset +
+                                          PATTERN_ENTRY.size * mid)
+        start = pool_offset + pattern_offset
+        mid_key = index[start:start + n]
+        if mid_key < key:
+            lo = mid + 1
+        elif mid_key > key:
+            hi = mid
+        else:
+            return (pool_offset + words_offset, pool_offset + costs_offset,
+                    num_words)
+    return None
+
+def get_pattern_words(pattern):
+    """ Return the dictionary words with the given pattern, in rank order. """
+    entry = find_pattern_entry(pattern)
+    if entry is None:
+        return []
+    start, _, num_words = entry
+    n = len(pattern)
+    words = index[start:start + n * num_words].decode()
+    return [words[k:k + n] for k in range(0, len(words), n)]
+
+def get_pattern_costs(pattern):
+    """ Return the costs of get_pattern_words(pattern), in the same order. """
+    entry = find_pattern_entry(pattern)
+    if entry is None:
+        return []
+    _, start, num_words = entry
+    return list(struct.unpack_from(f'<{num_words}f', index, start))
+
+def get_all_word_costs():
+    """ Return a dict mapping every dictionary word to its cost. """
+    entries_offset = INDEX_HEADER.size + LENGTH_ENTRY.size * (index_max_len + 1)
+    pool_offset    = entries_offset + PATTERN_ENTRY.size * index_num_entries
+    word_costs = {}
+    for entry_idx in range(index_num_entries):
+        pattern_offset, words_offset, costs_offset, num_words = \
+                PATTERN_ENTRY.unpack_from(index, entries_offset +
+                                          PATTERN_ENTRY.size * entry_idx)
+        n = (costs_offset - words_offset) // num_words
+        start = pool_offset + words_offset
+        words = index[start:start + n * num_words].decode()
+        costs = struct.unpack_from(f'<{num_words}f', index,
+                                   pool_offset + costs_offset)
+        for k, cost in enumerate(costs):
+            word_costs[words[k * n:(k + 1) * n]] = cost
+    return word_costs
+
+def set_pool_search(search):
+    """ Set `pool_search`; this initializes worker processes. """
+    global pool_search
+    pool_search = search
+
+def list_seed_matches(seed):
+    """ Return (seed, matches), where the matches of search_seed(seed) are
+        given as a list. This runs in the worker processes of find_matches().
+    """
+    return seed, list(pool_search.search_seed(seed))
+
+def list_part_best_matches(part):
+    """ Return (matches, timed_out) for one part of a search, as given by
+        Search.get_best_matches(*part). This runs in the worker processes of
+        find_best_matches().
+    """
+    return pool_search.get_best_matches(*part)
+
+def set_pool_matcher(matcher, max_results, timeout):
+    """ Set `pool_matcher` and the query limits; this initializes worker
+        processes.
+    """
+    global pool_matcher, pool_limits
+    pool_matcher = matcher
+    pool_limits  = (max_results, timeout)
+
+def answer_pool_query(line):
+    """ Return (answer, hits, misses, new_entries), where answer is
+        answer_query() for `line`, hits and misses are how much answering it
+        added to the worker's cache counts, and new_entries lists the (key,
+        domain) cache entries it added. This runs in the worker processes of
+        answer_batch().
+    """
+    cache = pool_matcher.cache
+    hits, misses = cache.hits, cache.misses
+    cache.new_keys = []
+    answer = answer_query(pool_matcher, line, *pool_limits)
+    with cache.lock:
+        new_entries = [
+                (key, cache.entries[key])
+                for key in cache.new_keys
+                if key in cache.entries
+        ]
+        cache.new_keys = None
+    return answer, cache.hits - hits, cache.misses - misses, new_entries
+
+def answer_query(matcher, line, max_results=N_MATCHES_TO_SHOW, timeout=None):
+    """ Return the JSON-ready answer to a query, given as a line of JSON.
+
+        The query's own "limit" and "timeout" are capped by `max_results` and
+        `timeout`; a `timeout` of None means there is no time limit.
+    """
+    try:
+        query = json.loads(line)
+        if isinstance(query, list):
+            query = {'ciphers': query}
+        if query.get('stats'):
+            return {'stats': matcher.cache.get_stats()}
+        ciphers = query['ciphers']
+        limit   = min(int(query.get('limit', max_results)), max_results)
+        if limit < 0:
+            raise ValueError('limit must not be negative')
+        if query.get('timeout') is not None:
+            query_timeout = float(query['timeout'])
+            if timeout is None or query_timeout < timeout:
+                timeout = query_timeout
+        if not isinstance(ciphers, list) or not all(
+                isinstance(cipher, str) for cipher in ciphers):
+            raise TypeError('ciphers must be a list of strings')
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        return {'error': f'Bad query: {e!r}'}
+
+    matches = []
+    timed_out = False
+    try:
+        for max_rank, words, mapping in matcher.iter_matches(
+                ciphers, limit, timeout=timeout):
+            matches.append({
+                'max_rank': max_rank,
+                'words': words,
+                'mapping': mapping
+            })
+    except TimeoutError:
+        timed_out = True
+    answer = {'matches': matches, 'timed_out': timed_out}
+    if 'id' in query:
+        answer['id'] = query['id']
+    return answer
+
+def is_stale_socket(path):
+    """ Return True iff `path` is a Unix socket that no server is listening on.
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return False
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+    except ConnectionRefusedError:
+        return True
+    except OSError:
+        return False
+    return False
+
+def answer_batch(matcher, lines, jobs=1, max_results=N_MATCHES_TO_SHOW,
+                 timeout=None):
+    """ Yield the answer to each non-blank query in `lines`, in order. When
+        jobs > 1, queries are answered in a pool of forked processes. Each
+        worker has its own copy of the matcher's candidate cache, so the
+        workers don't share entries with each other; but the entries they add
+        and their hit and miss counts are merged back into the matcher's cache.
+    """
+    lines = (line for line in lines if line.strip())
+    if jobs == 1:
+        for line in lines:
+            yield answer_query(matcher, line, max_results, timeout)
+        return
+
+    ctx = multiprocessing.get_context('fork')
+    initargs = (matcher, max_results, timeout)
+    cache = matcher.cache
+    with ctx.Pool(jobs, set_pool_matcher, initargs) as pool:
+        for answer, hits, misses, new_entries in pool.imap(
+                answer_pool_query, lines, chunksize=16):
+            with cache.lock:
+                cache.hits   += hits
+                cache.misses += misses
+                for key, domain in new_entries:
+                    cache.add(key, domain)
+            yield answer
 
 
 # ____________________________________________________________
-# Main
+# Classes
 
-if len(sys.argv) < 2:
-    print(__doc__)
-    sys.exit(0)
-
-ciphers = sys.argv[1:]
-load_dictionary()
-
-# Build up a list of all possibilities. Each candidate is stored as
-# (max_rank, word_list), where max_rank is the maximum rank among all
-# the words in word_list. This allows us to sort by decreasing max_rank
-# and display more likely plaintext candidates first.
-
-num_words   = len(ciphers)
-plain_words = []  # plain_words[i] = [(len_i_plain_word, rank)*]
-for cipher in ciphers:
-    n = len(cipher)
-    num_cipher_letters = len(set(list(cipher)))
-    len_n_words = words[n]
-    plain_words.append([
-        w
-        for w in len_n_words
-        if is_match(cipher, w, num_cipher_letters, n)
-    ])
+class CandidateCache:
+    """ A thread-safe LRU cache of (plain_words, pos_masks, any_masks, costs)
+        domains, keyed by get_cache_key(cipher). It holds at most `max_words`
+        candidate words in total, and counts its hits and misses.
+    """
+
+    def __init__(self, max_words=MAX_CACHED_WORDS):
+        self.max_words = max_words
+        self.num_words = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.entries   = OrderedDict()
+        self.lock      = threading.Lock()
+        self.new_keys  = None  # If a list, each added key is appended to it.
+
+    def get_domain(self, cipher):
+        key = get_cache_key(cipher)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+
+        plain_words, costs = get_candidates(key)
+        domain = (plain_words,) + get_masks(plain_words) + (costs,)
+        with self.lock:
+            self.add(key, domain)
+            if self.new_keys is not None:
+                self.new_keys.append(key)
+        return domain
+
+    def add(self, key, domain):
+        """ Add an entry, evicting the least recently used ones as needed. This
+            expects the caller to hold self.lock.
+        """
+        if key in self.entries:
+            return
+        self.entries[key] = domain
+        self.num_words += len(domain[0])
+        while self.num_words > self.max_words and len(self.entries) > 1:
+            _, old_domain = self.entries.popitem(last=False)
+            self.num_words -= len(old_domain[0])
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'words': self.num_words
+        }
+
+    def load(self, path):
+        """ Add the entries saved at `path` by save(), unless they were saved
+            for a different dictionary or the file can't be read.
+        """
+        try:
+            with open(path, 'rb') as f:
+                version, signature, entries = pickle.load(f)
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return
+        if (version, signature) != (INDEX_VERSION, index_signature):
+            return
+        with self.lock:
+            for key, domain in entries:
+                self.add(key, domain)
+
+    def save(self, path):
+        """ Save the entries to `path`, replacing the file atomically. """
+        with self.lock:
+            entries = list(self.entries.items())
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((INDEX_VERSION, index_signature, entries), f)
+        os.replace(tmp_path, path)
 
-print('\nList lengths:')
-k = max(map(len, ciphers))
-fmt = f'%-{k}s'
-for i, word_list in enumerate(plain_words):
-    print(fmt % ciphers[i], len(word_list))
-print()
-
-# Iterate over all tuples from plain_words, and pick out the compatible ones.
-
-def find_matches():
-    decrypts = []  # Each item is (max_rank, word_list).
-    idx = [0] * num_words
-    max_depth = 0
-    max_max_depth = max(map(len, plain_words))
-    seen = set()
-    num_found = 0
-    print_count = 0
-    while True:
-        if tuple(idx) not in seen:
-
-            if print_count % 10_000 == 0:
-                status = f'[{max_depth:3d}] ' + ' '.join(map(itoa, idx)) + ' ' * 5
-                print('\r' + status, end='', flush=True)
-            print_count += 1
-
-            encoder, decoder = {}, {}
-            letter_map = {}
-            max_rank   = 0
-            decrypt    = []
-            for i in range(num_words):
-                plain_word = plain_words[i][idx[i]]
-                if did_update_map(decoder, encoder, ciphers[i], plain_word):
-                    max_rank = max(max_rank, idx[i])
-                    decrypt.append(plain_word)
+class Search:
+    """ The state of a single query: the cipher words, their candidates, and
+        the bitsets used to narrow those candidates during the search.
+    """
+
+    def __init__(self, ciphers, candidates):
+        """ This expects candidates[i] = (plain_words, pos_masks, any_masks,
+            costs) for ciphers[i], as given by Matcher.get_domain().
+        """
+        self.ciphers     = ciphers
+        self.num_words   = len(ciphers)
+        self.plain_words = [c[0] for c in candidates]
+        self.pos_masks   = [c[1] for c in candidates]
+        self.any_masks   = [c[2] for c in candidates]
+        self.costs       = [c[3] for c in candidates]
+        self.num_nodes   = 0
+        self.deadline    = None  # A time.monotonic() value, if set.
+
+        # Precompute, for each cipher word, the first position of each of its
+        # letters. Each cipher word is also scored by how many of its letters
+        # appear in other cipher words; this breaks ties when search() chooses
+        # which word to decode next.
+        self.first_pos = [
+                {letter: cipher.index(letter) for letter in cipher}
+                for cipher in ciphers
+        ]
+        self.num_shared = [
+                len(set(cipher) & set(''.join(ciphers[:i] + ciphers[i + 1:])))
+                for i, cipher in enumerate(ciphers)
+        ]
+
+    def check_deadline(self):
+        """ Raise TimeoutError if we have passed our deadline. """
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise TimeoutError('The search ran out of time.')
+
+    def narrow(self, domains, letter_pairs):
+        """ Return a copy of `domains` keeping only the candidates that agree
+            with each new (cipher_letter, plain_letter) pair in `letter_pairs`,
+            or None as soon as any domain becomes empty.
+
+            A domain is a bitset over plain_words[j]. If word j contains the
+            cipher letter, we keep the candidates with plain_letter at its first
+            position; since candidates share the cipher word's pattern, this
+            also fixes the other positions. Otherwise we drop every candidate
+            that uses plain_letter, as it is now taken by another cipher letter.
+        """
+        new_domains = {}
+        for j, domain in domains.items():
+            first_pos_j = self.first_pos[j]
+            for cipher_letter, plain_letter in letter_pairs:
+                if cipher_letter in first_pos_j:
+                    pos = first_pos_j[cipher_letter]
+                    domain &= self.pos_masks[j][pos].get(plain_letter, 0)
                 else:
-                    break
-            else:  # Didn't break out.
-                decrypts.append((max_rank, decrypt))
-                num_found += 1
-                print('\r' + f'{num_found:2d}.' + ' '.join(decrypt) + ' ' * 20)
-                if num_found == N_MATCHES_TO_SHOW:
-                    print()
-                    print(f'(Stopping after finding {N_MATCHES_TO_SHOW} matches.)')
-                    sys.exit(0)
-        seen.add(tuple(idx))
-
-        # This next block updates idx, counting up while keep each element <=
-        # max_depth. Note that we will repeat some idx values, but skip those
-        # quickly by looking at `seen`. However, I wonder if there's a better
-        # way to do this that avoids the need for `seen` at all.
-        incrementables = [
-                j
-                for j in range(num_words)
-                # Don't use `min` here; this is faster without it.
-                if idx[j] < len(plain_words[j]) - 1 and idx[j] < max_depth - 1
+                    domain &= ~self.any_masks[j].get(plain_letter, 0)
+            if domain == 0:
+                return None
+            new_domains[j] = domain
+        return new_domains
+
+    def choose_word(self, domains):
+        """ Return the index of the most constrained word in `domains`. """
+        return min(domains, key=lambda j: (domains[j].bit_count(),
+                                           -self.num_shared[j]))
+
+    def search(self, domains, decoder, decrypt):
+        """ Yield each full (decrypt, decoder) extending the given partial
+            solution.
+
+            `domains` maps each not-yet-decoded word index to the bitset of its
+            candidates that are still consistent with `decoder`. We decode the
+            most constrained word next, and narrow every other domain as soon
+            as its letters are fixed, so that dead branches are abandoned early.
+        """
+        if len(domains) == 0:
+            yield list(decrypt), decoder
+            return
+
+        i = self.choose_word(domains)
+        domain = domains.pop(i)
+        new_letters = [
+                (cipher_letter, pos)
+                for cipher_letter, pos in self.first_pos[i].items()
+                if cipher_letter not in decoder
         ]
-        if len(incrementables) == 0:
-            if max_depth == max_max_depth:
+        while domain:
+            self.num_nodes += 1
+            if self.num_nodes % 1024 == 0:
+                self.check_deadline()
+            low_bit = domain & -domain
+            domain ^= low_bit
+            plain_word = self.plain_words[i][low_bit.bit_length() - 1]
+            letter_pairs = [
+                    (cipher_letter, plain_word[pos])
+                    for cipher_letter, pos in new_letters
+            ]
+            new_domains = self.narrow(domains, letter_pairs)
+            if new_domains is None:
+                continue
+            decrypt[i] = plain_word
+            new_decoder = dict(decoder)
+            new_decoder.update(letter_pairs)
+            yield from self.search(new_domains, new_decoder, decrypt)
+
+    # We enumerate all compatible tuples from plain_words in order of max_rank.
+    # Every decrypt with max_rank == depth has a first word i with rank exactly
+    # depth; earlier words have smaller ranks, and later ones are at most
+    # depth. Pinning that word and backtracking over the rest visits each
+    # decrypt once, so this holds nothing but the current search path in
+    # memory; in particular, it never remembers which decrypts it has produced.
+    #
+    # Each (depth, i) pair is a seed, and seeds are independent of each other.
+    # This is how find_matches() splits the search across worker processes.
+
+    def get_seeds(self):
+        """ Yield each (depth, i) seed, in the order its matches should appear.
+        """
+        max_max_depth = max(map(len, self.plain_words))
+        for depth in range(max_max_depth):
+            for i in range(self.num_words):
+                if depth < len(self.plain_words[i]):
+                    yield depth, i
+
+    def search_seed(self, seed):
+        """ Yield (depth, decrypt, decoder) for each decrypt in which word i is
+            the first word with rank `depth`, where seed = (depth, i).
+        """
+        depth, i = seed
+        self.check_deadline()
+        plain_word = self.plain_words[i][depth]
+        decoder = {
+                cipher_letter: plain_word[pos]
+                for cipher_letter, pos in self.first_pos[i].items()
+        }
+        domains = self.narrow({
+                j: (1 << min(depth + (j > i), len(self.plain_words[j]))) - 1
+                for j in range(self.num_words)
+                if j != i
+        }, decoder.items())
+        if domains is None:
+            return
+
+        decrypt = [None] * self.num_words
+        decrypt[i] = plain_word
+        for decrypt, decoder in self.search(domains, decoder, decrypt):
+            yield depth, decrypt, decoder
+
+    def find_matches(self, jobs=1, progress=None):
+        """ Yield (max_rank, decrypt, decoder) for every decrypt of the cipher
+            words, in non-decreasing order of max_rank. The `decoder` maps each
+            cipher letter to its plain letter. If given, progress(depth,
+            num_nodes) is called every so often during long searches.
+
+            When jobs > 1, the seeds are searched in a pool of forked processes.
+            Forking lets the workers share the dictionary index and the
+            candidate bitsets copy-on-write, so only seeds and matches are ever
+            pickled.
+        """
+        if self.num_words == 0 or not all(self.plain_words):
+            return
+
+        progress_count = 0
+        if jobs == 1:
+            for depth, i in self.get_seeds():
+                if progress and self.num_nodes >= progress_count:
+                    progress(depth, self.num_nodes)
+                    progress_count = self.num_nodes + 10_000
+                yield from self.search_seed((depth, i))
+            return
+
+        # We yield each seed's list of matches in seed order, which keeps the
+        # merged matches in rank order. Only MAX_SEEDS_AHEAD seeds per worker
+        # are ever submitted beyond the one being yielded, so the workers can't
+        # run far past a consumer that has stopped early; when the consumer
+        # closes this generator, the pool is terminated.
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(jobs, set_pool_search, (self,)) as pool:
+            seeds = self.get_seeds()
+            pending = deque(
+                    pool.apply_async(list_seed_matches, (seed,))
+                    for seed in itertools.islice(seeds, jobs * MAX_SEEDS_AHEAD)
+            )
+            seed_idx = 0
+            while pending:
+                (depth, _), matches = pending.popleft().get()
+                seed = next(seeds, None)
+                if seed is not None:
+                    pending.append(pool.apply_async(list_seed_matches, (seed,)))
+                if progress and seed_idx % 1_000 == 0:
+                    progress(depth, None)
+                seed_idx += 1
+                yield from matches
+
+    # The best matches are found by a depth-first branch-and-bound search. The
+    # candidates of each word are in order of cost, so the lowest set bit of a
+    # domain is its cheapest candidate, and the sum of these over the undecoded
+    # words is a lower bound on the cost of finishing a partial decrypt. We
+    # keep the best matches so far in a heap, and once it holds k of them, we
+    # drop any branch whose bound is no better than the worst of them. Within
+    # a word, a candidate that fails this test is followed only by costlier
+    # ones, so we stop there rather than trying the rest. Once the heap is
+    # full, we use the tighter bound of get_paired_min_cost(), which also
+    # charges for pairs of undecoded words whose cheapest candidates clash.
+
+    def get_min_cost(self, domains):
+        """ Return the sum, over the words in `domains`, of the cost of their
+            cheapest remaining candidate.
+        """
+        return sum(
+                self.costs[j][(domain & -domain).bit_length() - 1]
+                for j, domain in domains.items()
+        )
+
+    def get_pair_cost(self, i, domain_i, j, domain_j, max_cost):
+        """ Return a lower bound on the cost of decoding words i and j with
+            candidates from `domain_i` and `domain_j` that agree with each
+            other. The bound is exact when it is below `max_cost`.
+        """
+        min_cost_j = self.costs[j][(domain_j & -domain_j).bit_length() - 1]
+        best_cost = math.inf
+        first_pos_i = self.first_pos[i]
+        while domain_i:
+            low_bit = domain_i & -domain_i
+            domain_i ^= low_bit
+            k = low_bit.bit_length() - 1
+            cost_i = self.costs[i][k]
+            if cost_i + min_cost_j >= min(best_cost, max_cost):
+                return min(best_cost, cost_i + min_cost_j)
+            plain_word = self.plain_words[i][k]
+            letter_pairs = [
+                    (cipher_letter, plain_word[pos])
+                    for cipher_letter, pos in first_pos_i.items()
+            ]
+            new_domains = self.narrow({j: domain_j}, letter_pairs)
+            if new_domains is None:
+                continue
+            new_domain = new_domains[j]
+            best_cost = min(best_cost, cost_i + self.costs[j][
+                    (new_domain & -new_domain).bit_length() - 1])
+        return best_cost
+
+    def get_paired_min_cost(self, domains, max_cost):
+        """ Return a lower bound on the cost of decoding the words in
+            `domains`, at least get_min_cost(domains), found by pairing up the
+            words and charging each pair its cheapest candidates that agree.
+            Once the bound reaches `max_cost`, we may return early.
+        """
+        min_costs = {
+                j: self.costs[j][(domain & -domain).bit_length() - 1]
+                for j, domain in domains.items()
+        }
+        total = sum(min_costs.values())
+        words = list(domains)
+        for i, j in zip(words[0::2], words[1::2]):
+            if total >= max_cost:
+                break
+            pair_max_cost = max_cost - total + min_costs[i] + min_costs[j]
+            total += self.get_pair_cost(i, domains[i], j, domains[j],
+                                        pair_max_cost)
+            total -= min_costs[i] + min_costs[j]
+        return total
+
+    def branch(self, domains, decoder, decrypt, cost):
+        """ Add to self.best each full decrypt extending the given partial
+            solution of cost `cost` that may be among the k best.
+        """
+        if len(domains) == 0:
+            entry = (-cost, self.num_found, list(decrypt), decoder)
+            self.num_found += 1
+            if len(self.best) < self.k:
+                heapq.heappush(self.best, entry)
+            else:
+                heapq.heapreplace(self.best, entry)
+            return
+
+        i = self.choose_word(domains)
+        domain = domains.pop(i)
+        if len(self.best) == self.k:
+            rest_cost = self.get_paired_min_cost(
+                    domains, -self.best[0][0] - cost)
+        else:
+            rest_cost = self.get_min_cost(domains)
+        new_letters = [
+                (cipher_letter, pos)
+                for cipher_letter, pos in self.first_pos[i].items()
+                if cipher_letter not in decoder
+        ]
+        while domain:
+            self.num_nodes += 1
+            if self.num_nodes % 1024 == 0:
+                self.check_deadline()
+                if self.progress and self.num_nodes % 10_240 == 0:
+                    self.progress(self.num_words - len(domains) - 1,
+                                  self.num_nodes)
+            low_bit = domain & -domain
+            domain ^= low_bit
+            k = low_bit.bit_length() - 1
+            new_cost = cost + self.costs[i][k]
+            max_cost = -self.best[0][0] if len(self.best) == self.k else None
+            if max_cost is not None and new_cost + rest_cost >= max_cost:
+                break
+            plain_word = self.plain_words[i][k]
+            letter_pairs = [
+                    (cipher_letter, plain_word[pos])
+                    for cipher_letter, pos in new_letters
+            ]
+            new_domains = self.narrow(domains, letter_pairs)
+            if new_domains is None:
+                continue
+            if max_cost is not None and new_cost + self.get_paired_min_cost(
+                    new_domains, max_cost - new_cost) >= max_cost:
+                continue
+            decrypt[i] = plain_word
+            new_decoder = dict(decoder)
+            new_decoder.update(letter_pairs)
+            self.branch(new_domains, new_decoder, decrypt, new_cost)
+
+    def get_best_matches(self, k, i=None, domain=None, progress=None):
+        """ Return (matches, timed_out), where matches is a list of (cost,
+            decrypt, decoder) for the k lowest-cost decrypts, cheapest first.
+            If `i` is given, only the candidates of word i in the bitset
+            `domain` are tried for it. If we pass our deadline, timed_out is
+            True and the matches are the best ones found so far.
+        """
+        self.k         = k
+        self.best      = []
+        self.num_found = 0
+        self.progress  = progress
+        domains = {
+                j: (1 << len(self.plain_words[j])) - 1
+                for j in range(self.num_words)
+        }
+        if i is not None:
+            domains[i] = domain
+        timed_out = False
+        try:
+            self.branch(domains, {}, [None] * self.num_words, 0.0)
+        except TimeoutError:
+            timed_out = True
+        matches = [
+                (-neg_cost, decrypt, decoder)
+                for neg_cost, _, decrypt, decoder in sorted(
+                        self.best, key=lambda entry: (-entry[0], entry[1]))
+        ]
+        return matches, timed_out
+
+    def find_best_matches(self, k, jobs=1, progress=None):
+        """ Return (matches, timed_out), where matches is a list of (cost,
+            decrypt, decoder) for the k lowest-cost decrypts of the cipher
+            words, cheapest first; the `decoder` maps each cipher letter to its
+            plain letter. If we pass our deadline, timed_out is True and the
+            matches are the best ones found so far. If given, progress(depth,
+            num_nodes) is called every so often during long searches.
+
+            When jobs > 1, the candidates of the most constrained word are
+            dealt out, in turn, into parts that are searched in a pool of
+            forked processes, and the best matches of all the parts are merged.
+        """
+        if self.num_words == 0 or k <= 0 or not all(self.plain_words):
+            return [], False
+        if jobs == 1:
+            return self.get_best_matches(k, progress=progress)
+
+        i = self.choose_word({
+                j: (1 << len(self.plain_words[j])) - 1
+                for j in range(self.num_words)
+        })
+        num_candidates = len(self.plain_words[i])
+        num_parts = min(jobs * 4, num_candidates)
+        parts = [
+                (k, i, sum(1 << b for b in range(start, num_candidates,
+                                                 num_parts)))
+                for start in range(num_parts)
+        ]
+        ctx = multiprocessing.get_context('fork')
+        with ctx.Pool(jobs, set_pool_search, (self,)) as pool:
+            part_matches = pool.imap_unordered(list_part_best_matches, parts)
+            all_matches = []
+            timed_out = False
+            for part_idx, (matches, part_timed_out) in enumerate(part_matches):
+                if progress:
+                    progress(part_idx, None)
+                all_matches.extend(matches)
+                timed_out |= part_timed_out
+        matches = heapq.nsmallest(k, all_matches, key=lambda match: match[0])
+        return matches, timed_out
+
+class Propagation:
+    """ Arc consistency over the letters of a set of cipher words. This finds,
+        much faster than listing every match, which plain letters each cipher
+        letter may still map to, and how often.
+
+        Each cipher letter has a set of options, the plain letters it may map
+        to. Each cipher word has a bitset of the candidates whose letters are
+        all options at their positions; an option is dropped when no candidate
+        left in some word supports it. A letter with a single option takes it
+        from every other letter. We repeat this until nothing changes, so the
+        result keeps every full match, but may keep some that don't extend to
+        one.
+
+        States are cached by their set of fixed letters. A new set of fixed
+        letters starts from the cached state with the largest subset of them,
+        since fixing more letters can only remove options.
+    """
+
+    def __init__(self, ciphers, candidates, max_states=N_CACHED_STATES):
+        """ This expects candidates[i] = (plain_words, pos_masks, any_masks,
+            costs) for ciphers[i], as given by Matcher.get_domain(). Cipher
+            words with no candidates, such as names, are ignored.
+        """
+        words = {
+                cipher: candidate
+                for cipher, candidate in zip(ciphers, candidates)
+                if candidate[0]
+        }
+        self.ciphers    = list(words)
+        self.pos_masks  = [words[cipher][1] for cipher in self.ciphers]
+        self.full_masks = [(1 << len(words[c][0])) - 1 for c in self.ciphers]
+        self.words_of   = defaultdict(set)  # cipher letter -> word indexes
+        self.first_pos  = []
+        for i, cipher in enumerate(self.ciphers):
+            self.first_pos.append({c: cipher.index(c) for c in cipher})
+            for c in cipher:
+                self.words_of[c].add(i)
+        self.states     = OrderedDict()
+        self.max_states = max_states
+        self.lock       = threading.Lock()
+
+    def get_state(self, fixed):
+        """ Return (masks, options) after fixing the cipher letters in the dict
+            `fixed` to its plain letters, or None if that leaves no options.
+            Here masks[i] is the bitset of candidates left for word i, and
+            options maps each cipher letter to its set of plain letters.
+        """
+        key = frozenset(fixed.items())
+        with self.lock:
+            if key in self.states:
+                self.states.move_to_end(key)
+                return self.states[key]
+            base = max((k for k in self.states if k <= key), key=len,
+                       default=None)
+            base_state = self.states[base] if base is not None else None
+
+        if base is None:
+            masks = list(self.full_masks)
+            options = {c: set(string.ascii_lowercase) for c in self.words_of}
+            dirty = set(self.words_of)
+            new_pairs = key
+        elif base_state is None:
+            return None
+        else:
+            masks = list(base_state[0])
+            options = {c: set(opts) for c, opts in base_state[1].items()}
+            dirty = set()
+            new_pairs = key - base
+        for cipher_letter, plain_letter in new_pairs:
+            if cipher_letter in options:
+                options[cipher_letter] &= {plain_letter}
+                dirty.add(cipher_letter)
+
+        state = (masks, options) if self.propagate(masks, options, dirty) \
+                else None
+        with self.lock:
+            self.states[key] = state
+            if len(self.states) > self.max_states:
+                self.states.popitem(last=False)
+        return state
+
+    def propagate(self, masks, options, dirty):
+        """ Update masks and options in place until they are arc consistent,
+            given that the options of the cipher letters in `dirty` have
+            changed. Return False if some letter runs out of options.
+        """
+        dirty   = list(dirty)
+        queue   = set()  # These are the indexes of words to narrow.
+        singles = set()
+        while dirty or queue:
+
+            # A letter with only one option takes it from all other letters.
+            while dirty:
+                c = dirty.pop()
+                if len(options[c]) == 0:
+                    return False
+                if len(options[c]) == 1 and c not in singles:
+                    singles.add(c)
+                    letter = next(iter(options[c]))
+                    for d, opts in options.items():
+                        if d != c and letter in opts:
+                            opts.discard(letter)
+                            dirty.append(d)
+                queue.update(self.words_of[c])
+            if not queue:
                 break
-            max_depth += 1
-            idx = [0] * num_words
+
+            # Narrow a word to the candidates using only options, and drop the
+            # options that none of its remaining candidates use.
+            i = queue.pop()
+            pos_masks = self.pos_masks[i]
+            mask = masks[i]
+            for c, pos in self.first_pos[i].items():
+                allowed = 0
+                for letter in options[c]:
+                    allowed |= pos_masks[pos].get(letter, 0)
+                mask &= allowed
+            masks[i] = mask
+            for c, pos in self.first_pos[i].items():
+                supported = {
+                        letter for letter in options[c]
+                        if pos_masks[pos].get(letter, 0) & mask
+                }
+                if supported != options[c]:
+                    options[c] = supported
+                    dirty.append(c)
+        return True
+
+    def get_letter_counts(self, fixed):
+        """ Return a dict mapping each cipher letter to a Counter of how many
+            remaining candidates map it to each plain letter, summed over the
+            words it appears in; or None if `fixed` leaves no options. See
+            get_state() for `fixed`.
+        """
+        state = self.get_state(fixed)
+        if state is None:
+            return None
+        masks, options = state
+        letter_counts = {}
+        for c, opts in options.items():
+            counts = Counter()
+            for i in self.words_of[c]:
+                pos_mask = self.pos_masks[i][self.first_pos[i][c]]
+                for letter in opts:
+                    counts[letter] += (masks[i] & pos_mask.get(letter, 0)).bit_count()
+            letter_counts[c] = counts
+        return letter_counts
+
+class Matcher:
+    """ Find simultaneous decodings of cipher words among dictionary words.
+
+        The dictionary is loaded once, when the first Matcher is made, so one
+        Matcher can answer any number of queries in-process.
+    """
+
+    def __init__(self, jobs=1, max_cached_words=MAX_CACHED_WORDS):
+        if index is None:
+            load_dictionary()
+        self.jobs  = jobs
+        self.cache = CandidateCache(max_cached_words)
+
+    def get_domain(self, cipher):
+        """ Return (plain_words, pos_masks, any_masks, costs) for `cipher`,
+            where (plain_words, costs) = get_candidates(cipher), and the masks
+            are as given by get_masks(plain_words).
+        """
+        return self.cache.get_domain(cipher)
+
+    def iter_matches(self, ciphers, limit=None, progress=None, timeout=None):
+        """ Return a lazy iterator over (max_rank, words, mapping) for each way
+            to decode all of `ciphers` simultaneously, most likely first.
+
+            Here `words` lists the plain word for each cipher word, max_rank is
+            the highest rank among them, and `mapping` maps cipher letters to
+            plain letters. At most `limit` matches are produced, if given; see
+            Search.find_matches() for `progress`. If `timeout` is given, the
+            iterator raises TimeoutError once that many seconds have passed
+            since this call.
+        """
+        search = Search(ciphers, [self.get_domain(c) for c in ciphers])
+        if timeout is not None:
+            search.deadline = time.monotonic() + timeout
+        matches = search.find_matches(self.jobs, progress)
+        return itertools.islice(matches, limit)
+
+    def best_matches(self, ciphers, k, progress=None, timeout=None):
+        """ Return (matches, timed_out), where matches is a list of (cost,
+            words, mapping) for the k lowest-cost ways to decode all of
+            `ciphers` simultaneously, cheapest first.
+
+            Here `words` and `mapping` are as in iter_matches(), and cost is
+            the sum of the costs of the words. See Search.find_best_matches()
+            for `progress`. If `timeout` is given, the search stops once that
+            many seconds have passed; timed_out is then True, and the matches
+            are the best ones found so far.
+        """
+        search = Search(ciphers, [self.get_domain(c) for c in ciphers])
+        if timeout is not None:
+            search.deadline = time.monotonic() + timeout
+        return search.find_best_matches(k, self.jobs, progress)
+
+class MatchHandler(socketserver.StreamRequestHandler):
+    """ Answer each line of JSON sent over a connection to a MatchServer. """
+
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                answer = self.server.answer(line)
+                self.wfile.write(json.dumps(answer).encode() + b'\n')
+                self.wfile.flush()
+
+class MatchServer(socketserver.UnixStreamServer):
+    """ A server that answers match queries using one warm Matcher. Each
+        connection is handled by one of a fixed number of worker threads.
+    """
+
+    def __init__(self, socket_path, matcher, num_workers=N_SERVER_WORKERS,
+                 max_results=N_MATCHES_TO_SHOW, timeout=SERVER_TIMEOUT_SEC):
+        self.matcher     = matcher
+        self.max_results = max_results
+        self.timeout     = timeout
+        self.workers     = ThreadPoolExecutor(num_workers)
+        super().__init__(socket_path, MatchHandler)
+
+    def process_request(self, request, client_address):
+        self.workers.submit(self.process_request_in_worker, request,
+                            client_address)
+
+    def process_request_in_worker(self, request, client_address):
+        # This mirrors socketserver.ThreadingMixIn.process_request_thread().
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.workers.shutdown(wait=False, cancel_futures=True)
+
+    def answer(self, line):
+        """ Return the JSON-ready answer to a query, given as a line of JSON.
+        """
+        return answer_query(self.matcher, line, self.max_results, self.timeout)
+
+
+# ____________________________________________________________
+# Main
+
+def print_progress(depth, num_nodes):
+    if num_nodes is None:
+        print(f'\r[{depth:3d}]', end='', flush=True)
+    else:
+        print(f'\r[{depth:3d}] {num_nodes} nodes', end='', flush=True)
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--jobs', '-j', type=int, default=1)
+    parser.add_argument('--serve', metavar='SOCKET_PATH')
+    parser.add_argument('--workers', type=int, default=N_SERVER_WORKERS)
+    parser.add_argument('--timeout', type=float)
+    parser.add_argument('--batch', metavar='QUERIES_FILE')
+    parser.add_argument('--max-results', type=int)
+    parser.add_argument('--cache', metavar='CACHE_FILE')
+    parser.add_argument('--stats', action='store_true')
+    parser.add_argument('--best', action='store_true')
+    parser.add_argument('ciphers', nargs='*')
+    args = parser.parse_args()
+
+    if not (args.serve or args.batch or args.ciphers):
+        parser.error('at least one cipher word is required')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1.')
+    if args.workers < 1:
+        parser.error('--workers must be at least 1.')
+    if args.max_results is None:
+        args.max_results = (N_BEST_MATCHES_TO_SHOW if args.best else
+                            N_MATCHES_TO_SHOW)
+    if args.max_results < 0:
+        parser.error('--max-results must not be negative.')
+    if args.serve and args.jobs > 1:
+        parser.error('--jobs does not apply to --serve; use --workers.')
+
+    # In --batch mode, --jobs applies across queries rather than within them.
+    # A server answers each query in one of its worker threads, never forking.
+    matcher = Matcher(jobs=(1 if args.batch or args.serve else args.jobs))
+    if args.cache:
+        matcher.cache.load(args.cache)
+
+    if args.serve:
+        # Remove any stale socket left behind by an earlier server, but never
+        # a live server's socket or a file that isn't a socket.
+        if os.path.exists(args.serve):
+            if not is_stale_socket(args.serve):
+                parser.error(f'{args.serve} exists and is not a stale socket')
+            os.remove(args.serve)
+        if args.timeout is None:
+            args.timeout = SERVER_TIMEOUT_SEC
+        server = MatchServer(args.serve, matcher, args.workers,
+                             args.max_results, args.timeout)
+        print(f'Serving matches at {args.serve}.')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(args.serve)
+
+    elif args.batch:
+        queries = sys.stdin if args.batch == '-' else open(args.batch)
+        answers = answer_batch(matcher, queries, args.jobs, args.max_results,
+                               args.timeout)
+        for answer in answers:
+            sys.stdout.write(json.dumps(answer) + '\n')
+
+    else:
+        ciphers = args.ciphers
+
+        print('\nList lengths:')
+        k = max(map(len, ciphers))
+        fmt = f'%-{k}s'
+        for cipher in ciphers:
+            print(fmt % cipher, len(matcher.get_domain(cipher)[0]))
+        print()
+
+        num_found = 0
+        try:
+            if args.best:
+                matches, timed_out = matcher.best_matches(
+                        ciphers, args.max_results, print_progress, args.timeout)
+                print('\r' + ' ' * 40, end='\r')
+                for num_found, (cost, words, _) in enumerate(matches, 1):
+                    print(f'{num_found:2d}.' + ' '.join(words) +
+                          f'  ({cost:.1f})')
+                if timed_out:
+                    raise TimeoutError('The search ran out of time.')
+            else:
+                matches = matcher.iter_matches(ciphers, args.max_results,
+                                               print_progress, args.timeout)
+                for _, words, _ in matches:
+                    num_found += 1
+                    print('\r' + f'{num_found:2d}.' + ' '.join(words) +
+                          ' ' * 20)
+        except TimeoutError:
+            print('\r' + ' ' * 40)
+            print(f'(Stopping after {args.timeout} seconds.)')
         else:
-            j = incrementables[-1]
-            idx[j] += 1
-            for k in range(j + 1, num_words):
-                idx[k] = 0
+            if num_found == args.max_results:
+                print()
+                print(f'(Stopping after finding {args.max_results} matches.)')
+            else:
+                print('\r' + ' ' * 40)
 
-find_matches()
+    if args.cache:
+        matcher.cache.save(args.cache)
+    if args.stats:
+        print('Candidate cache:', json.dumps(matcher.cache.get_stats()),
+              file=sys.stderr)
@@ -0,0 +1,120 @@
+""" ngrams.py
+
+    English n-gram tables for scoring candidate decryptions.
+
+    A table for n-grams is a flat array of 26**n log-probabilities. The n-gram
+    with letter codes c_1, ..., c_n (where a = 0, ..., z = 25) is at index
+    c_1 * 26**(n - 1) + ... + c_n. N-grams that never appeared in the source
+    text get a floor value a bit below the rarest n-gram that did.
+
+    The tables are built from a text corpus by data/build_ngram_tables.py,
+    which writes each one to data/ngrams<n>.bin as a header (TABLE_HEADER)
+    followed by the table as little-endian float32 values. These files are
+    memory-mapped, so loading them is instant and the pages are shared between
+    processes. If there is no bigram table file, the bigram table is made from
+    data/bigram_freqs.json, as written by data/find_bigram_freqs.py.
+"""
+
+
+# ______________________________________________________________________
+# Imports
+
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+
+# ______________________________________________________________________
+# Globals and constants
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+BIGRAM_FREQS_PATH = os.path.join(DATA_DIR, 'bigram_freqs.json')
+
+# The n-gram table files hold the tables for n = 2, ..., MAX_N.
+MAX_N         = 4
+TABLE_MAGIC   = b'NGRAMTBL'
+TABLE_VERSION = 1
+TABLE_HEADER  = struct.Struct('<8sII')  # magic, version, n
+
+# Unseen n-grams are scored as being this many times rarer than the rarest
+# n-gram that was seen.
+FLOOR_FACTOR = 10
+
+tables = None  # This is set by load_tables().
+
+
+# ______________________________________________________________________
+# Functions
+
+def get_index(codes):
+    """ Return the table index of the n-gram with the given letter codes. """
+    idx = 0
+    for code in codes:
+        idx = idx * 26 + code
+    return idx
+
+def make_table(n, freqs):
+    """ Return the log-probability table for the n-grams in `freqs`, which maps
+        lowercase n-gram strings to their frequencies.
+    """
+    freqs = {
+            ngram: freq
+            for ngram, freq in freqs.items()
+            if len(ngram) == n and ngram.isalpha() and ngram.islower()
+            and ngram.isascii() and freq > 0
+    }
+    floor = math.log(min(freqs.values()) / FLOOR_FACTOR)
+    table = array('d', [floor]) * 26 ** n
+    for ngram, freq in freqs.items():
+        table[get_index([ord(c) - ord('a') for c in ngram])] = math.log(freq)
+    return table
+
+def get_table_path(n):
+    return os.path.join(DATA_DIR, f'ngrams{n}.bin')
+
+def write_table(path, n, table):
+    """ Write the n-gram table `table` to a table file at `path`. """
+    values = array('f', table)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    with open(path, 'wb') as f:
+        f.write(TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, n))
+        values.tofile(f)
+
+def map_table(path, n):
+    """ Return the n-gram table in the table file at `path`, as a memoryview
+        of a read-only memory map of the file.
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, file_n = TABLE_HEADER.unpack_from(data)
+    if (magic, version, file_n) != (TABLE_MAGIC, TABLE_VERSION, n):
+        raise ValueError(f'{path} is not a version {TABLE_VERSION} table of '
+                         f'{n}-grams.')
+    if sys.byteorder != 'little':
+        raise ValueError('Table files can only be mapped on little-endian '
+                         'machines.')
+    table = memoryview(data)[TABLE_HEADER.size:].cast('f')
+    if len(table) != 26 ** n:
+        raise ValueError(f'{path} is truncated.')
+    return table
+
+def load_tables():
+    """ Return a dict mapping each available n to its table, loading them the
+        first time this is called.
+    """
+    global tables
+
+    if tables is None:
+        tables = {}
+        for n in range(2, MAX_N + 1):
+            if os.path.exists(get_table_path(n)):
+                tables[n] = map_table(get_table_path(n), n)
+        if 2 not in tables:
+            with open(BIGRAM_FREQS_PATH) as f:
+                tables[2] = make_table(2, json.load(f))
+    return tables
@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+""" solver.py
+
+    Automatically solve a cryptogram by simulated annealing.
+
+    Usage:
+
+        ./solver.py [--restarts N] [--iterations N] [--seed N] [--jobs N]
+                    <cryptogram_text>
+        ./solver.py --hybrid [--iterations N] [--seed N] <cryptogram_text>
+
+    By default, each restart anneals for 30,000 steps; with --hybrid, each
+    partial key anneals for 2,000 steps, and --restarts and --jobs don't apply.
+
+    This searches for the key, a map from cipher letters to plain letters, that
+    makes the decrypted text look most like English. A key is scored by summing
+    the log-probabilities (from ngrams.py) of the letter n-grams within each
+    decrypted word, plus a bonus for each decrypted word that is in the
+    dictionary, larger for more common words. Each step of the search proposes
+    swapping the plain letters of two cipher letters, and rescores only the
+    n-grams and words containing them.
+
+    The n-grams alone don't tell words from gibberish with common bigrams,
+    which is all the shipped data/bigram_freqs.json gives; the word bonus is
+    what lets the default install solve a typical newspaper cryptogram. The
+    trigram and quadgram tables made by data/build_ngram_tables.py help more.
+    Very short cryptograms often have several dictionary decryptions, and
+    names can't be decrypted by the word bonus.
+
+    Each restart anneals independently from its own starting key. With --jobs
+    N, restarts run N at a time in worker processes. In either case, we stop
+    early once a restart's decryption consists of dictionary words, or once
+    PLATEAU_RESTARTS restarts have all reached the best decryption so far.
+
+    With --hybrid, we first choose a few of the most constrained cipher words;
+    these are the ones with the fewest dictionary candidates, such as long words
+    with repeated letters. The matches.py search finds the most likely ways to
+    decode them together, and each of those fixes part of the key. Annealing
+    then fills in only the rest of each partial key, and the n-gram scores pick
+    the best result. This avoids both the gibberish optima of pure n-gram
+    scoring and the combinatorial blowup of decoding every word by pattern.
+
+    The best decryption found is printed along with its key.
+"""
+
+
+# ______________________________________________________________________
+# Imports
+
+import argparse
+import math
+import multiprocessing
+import random
+import re
+import string
+import sys
+from collections import Counter
+
+import matches
+import ngrams
+
+
+# ______________________________________________________________________
+# Globals and constants
+
+N_RESTARTS   = 4
+N_ITERATIONS = 30_000
+
+# We stop once this many restarts agree on the best decryption.
+PLATEAU_RESTARTS = 3
+
+# These control solve_hybrid(). It decodes up to N_SEED_WORDS cipher words of
+# at least MIN_SEED_WORD_LEN letters by pattern, spending at most
+# SEED_SEARCH_SEC on that, and anneals from the best N_PARTIAL_KEYS results.
+N_SEED_WORDS      = 4
+MIN_SEED_WORD_LEN = 3
+SEED_SEARCH_SEC   = 1.0
+N_PARTIAL_KEYS    = 30
+N_HYBRID_ITERATIONS = 2_000
+
+# Annealing checks whether it has been asked to stop this often.
+STOP_CHECK_ITERATIONS = 1024
+
+# The annealing temperature falls geometrically from START_TEMP to END_TEMP
+# over each restart.
+START_TEMP = 5.0
+END_TEMP   = 0.1
+
+# Each cipher word that decrypts to a dictionary word adds this much per letter
+# to a key's score, less the word's cost from matches.py, so that common words
+# count for more than rare ones. This is what tells real words apart from
+# gibberish that merely has common bigrams.
+WORD_BONUS = 3.0
+
+# English letters, most frequent first. Restarts begin from a key that maps
+# cipher letters to these in order of their own frequency.
+ENGLISH_ORDER = 'etaoinshrdlcumwfgypbvkjxqz'
+
+# This is (crypt, scorer, iterations, stop) for run_restart(); it is set by
+# init_worker().
+pool_args = None
+
+# This counts the annealing steps taken in this process, for benchmarking.
+num_steps = 0
+
+word_costs = None  # This is set by load_word_costs().
+
+
+# ______________________________________________________________________
+# Functions
+
+def get_words(crypt):
+    """ Return the lowercase words of `crypt`, each as a list of letter codes.
+    """
+    return [
+            [ord(c) - ord('a') for c in word]
+            for word in re.findall('[a-z]+', crypt.lower())
+    ]
+
+def get_frequency_key(crypt):
+    """ Return the key that maps the cipher letters of `crypt`, by frequency,
+        to the letters of ENGLISH_ORDER.
+    """
+    counts = Counter(code for word in get_words(crypt) for code in word)
+    cipher_order = sorted(range(26), key=lambda code: -counts[code])
+    key = [0] * 26
+    for cipher_code, plain_letter in zip(cipher_order, ENGLISH_ORDER):
+        key[cipher_code] = ord(plain_letter) - ord('a')
+    return key
+
+def get_random_key(rng):
+    key = list(range(26))
+    rng.shuffle(key)
+    return key
+
+def key_to_str(key):
+    """ Return the 26 plain letters that cipher letters a-z map to. """
+    return ''.join(chr(ord('a') + code) for code in key)
+
+def decrypt(crypt, key):
+    """ Return `crypt` decrypted with `key`, preserving case and punctuation.
+    """
+    plain = key_to_str(key)
+    table = str.maketrans(string.ascii_lowercase + string.ascii_uppercase,
+                          plain + plain.upper())
+    return crypt.translate(table)
+
+def load_word_costs():
+    """ Return a dict mapping each dictionary word to its cost in matches.py,
+        loading it the first time this is called.
+    """
+    global word_costs
+
+    if word_costs is None:
+        if matches.index is None:
+            matches.load_dictionary()
+        word_costs = matches.get_all_word_costs()
+    return word_costs
+
+def is_dictionary_text(text):
+    """ Return True iff every word of `text` is a dictionary word. For a word
+        with an apostrophe, such as "can't", only the part before it counts.
+    """
+    if matches.index is None:
+        matches.load_dictionary()
+    for word in re.findall(r"([a-z]+)(?:'[a-z]+)?", text.lower()):
+        if word not in matches.get_pattern_words(matches.get_pattern(word)):
+            return False
+    return True
+
+def anneal(scorer, key, iterations, rng, fixed=(), stop=None):
+    """ Improve `key` in place by simulated annealing, and return
+        (best_score, best_key) for the best key seen along the way.
+
+        Cipher letters in `fixed` keep their plain letters, and no other cipher
+        letter is given one of those plain letters. If `stop` is given, it is
+        an Event that ends the annealing early once it is set.
+    """
+    global num_steps
+
+    letters = [code for code in scorer.letters if code not in fixed]
+    others  = [code for code in range(26) if code not in fixed]
+    score   = scorer.score(key)
+    best    = (score, list(key))
+    if len(letters) == 0 or len(others) < 2:
+        return best
+
+    cooling = (END_TEMP / START_TEMP) ** (1 / iterations)
+    temp = START_TEMP
+    steps = 0
+    for i in range(iterations):
+        if stop and i % STOP_CHECK_ITERATIONS == 0 and stop.is_set():
+            break
+        steps += 1
+        temp *= cooling
+        a, b = rng.choice(letters), rng.choice(others)
+        if a == b:
+            continue
+        delta = scorer.get_swap_delta(key, a, b)
+        if delta >= 0 or rng.random() < math.exp(delta / temp):
+            key[a], key[b] = key[b], key[a]
+            score += delta
+            if score > best[0]:
+                best = (score, list(key))
+
+    num_steps += steps
+
+    # Recompute the best score exactly, as the running sum may have drifted.
+    return scorer.score(best[1]), best[1]
+
+def complete_key(crypt, mapping):
+    """ Return a full key that extends `mapping`, a dict from cipher letters to
+        plain letters. The other cipher letters get the unused plain letters in
+        the order of get_frequency_key(crypt).
+    """
+    key = [None] * 26
+    for cipher_letter, plain_letter in mapping.items():
+        key[ord(cipher_letter) - ord('a')] = ord(plain_letter) - ord('a')
+    used = set(key)
+    unused = [code for code in get_frequency_key(crypt) if code not in used]
+    for cipher_code in range(26):
+        if key[cipher_code] is None:
+            key[cipher_code] = unused.pop(0)
+    return key
+
+def get_seed_words(crypt, matcher):
+    """ Return up to N_SEED_WORDS distinct cipher words of `crypt`, those with
+        the fewest candidates first, skipping words that have none.
+    """
+    words = set(re.findall('[a-z]+', crypt.lower()))
+    num_candidates = {
+            word: len(matcher.get_domain(word)[0])
+            for word in words
+            if len(word) >= MIN_SEED_WORD_LEN
+    }
+    seed_words = sorted(
+            (word for word in num_candidates if num_candidates[word] > 0),
+            key=lambda word: (num_candidates[word], -len(word), word)
+    )
+    return seed_words[:N_SEED_WORDS]
+
+def solve_hybrid(crypt, iterations=N_HYBRID_ITERATIONS, seed=None):
+    """ Return (score, key) for the best key found for `crypt` by combining
+        pattern matches with n-gram scores; see the usage notes above.
+    """
+    rng = random.Random(seed)
+    scorer = Scorer(crypt, ngrams.load_tables(), load_word_costs())
+    matcher = matches.Matcher()
+
+    # Find partial keys that decode the seed words. If the seed words can't all
+    # be decoded together, perhaps because one of them isn't in the dictionary,
+    # we retry without the least constrained one.
+    seed_words = get_seed_words(crypt, matcher)
+    mappings = []
+    while seed_words and not mappings:
+        try:
+            for _, _, mapping in matcher.iter_matches(
+                    seed_words, N_PARTIAL_KEYS, timeout=SEED_SEARCH_SEC):
+                mappings.append(mapping)
+        except TimeoutError:
+            pass
+        seed_words.pop()
+    if not mappings:
+        return solve(crypt, seed=seed)
+
+    best = None
+    for mapping in mappings:
+        fixed = {ord(cipher_letter) - ord('a') for cipher_letter in mapping}
+        key = complete_key(crypt, mapping)
+        result = anneal(scorer, key, iterations, rng, fixed)
+        if best is None or result[0] > best[0]:
+            best = result
+    return best
+
+def init_worker(crypt, scorer, iterations, stop):
+    """ Set up a worker process for solve(). """
+    global pool_args
+    pool_args = (crypt, scorer, iterations, stop)
+
+def run_restart(restart_seed):
+    """ Anneal from the starting key of one restart, and return the result.
+        This is run by worker processes, and by solve() itself when jobs == 1.
+    """
+    restart, seed = restart_seed
+    crypt, scorer, iterations, stop = pool_args
+    if stop.is_set():
+        return None
+    rng = random.Random(seed)
+    key = get_frequency_key(crypt) if restart == 0 else get_random_key(rng)
+    return anneal(scorer, key, iterations, rng, stop=stop)
+
+def is_done(crypt, results):
+    """ Return True iff the (score, key) restart results so far are enough to
+        stop; see the usage notes above.
+    """
+    best_text = decrypt(crypt, max(results)[1])
+    if is_dictionary_text(best_text):
+        return True
+    num_at_best = sum(decrypt(crypt, key) == best_text for _, key in results)
+    return num_at_best >= PLATEAU_RESTARTS
+
+def solve(crypt, restarts=N_RESTARTS, iterations=N_ITERATIONS, seed=None,
+          jobs=1):
+    """ Return (score, key) for the best key found for `crypt`. The first
+        restart begins from get_frequency_key(crypt); later ones are random.
+
+        When jobs > 1, restarts run in a pool of forked processes. Forking lets
+        the workers share the n-gram tables and the Scorer without copying
+        them. As soon as the results are good enough, a shared Event tells
+        every worker to stop.
+    """
+    rng = random.Random(seed)
+    restart_seeds = [(restart, rng.randrange(2 ** 32))
+                     for restart in range(restarts)]
+    scorer = Scorer(crypt, ngrams.load_tables(), load_word_costs())
+    if matches.index is None:
+        matches.load_dictionary()
+
+    results = []
+    ctx = multiprocessing.get_context('fork')
+    stop = ctx.Event()
+    if jobs == 1:
+        init_worker(crypt, scorer, iterations, stop)
+        for restart_seed in restart_seeds:
+            results.append(run_restart(restart_seed))
+            if is_done(crypt, results):
+                break
+        return max(results)
+
+    initargs = (crypt, scorer, iterations, stop)
+    with ctx.Pool(jobs, init_worker, initargs) as pool:
+        for result in pool.imap_unordered(run_restart, restart_seeds):
+            if result is None:
+                continue
+            results.append(result)
+            if is_done(crypt, results):
+                stop.set()
+                break
+    return max(results)
+
+
+# ______________________________________________________________________
+# Classes
+
+class Scorer:
+    """ Score keys for one cryptogram, either from scratch or incrementally.
+
+        The cryptogram is reduced to a list of (codes, count, table) items, one
+        per distinct cipher n-gram, where `codes` are the cipher letter codes,
+        `count` is how often the n-gram occurs within words, and `table` is the
+        n-gram log-probability table. A key's score is the sum over all items
+        of count * table[index of the decrypted n-gram].
+
+        If `word_costs` is given, it maps dictionary words to their costs, and
+        each cipher word that decrypts to one of them also adds WORD_BONUS per
+        letter, less the word's cost, or nothing if that is negative. As in
+        is_dictionary_text(), only the part of a word before an apostrophe is
+        looked up.
+    """
+
+    def __init__(self, crypt, tables, word_costs=None):
+        counts = Counter()
+        for word in get_words(crypt):
+            for n, table in tables.items():
+                for i in range(len(word) - n + 1):
+                    counts[tuple(word[i:i + n]), n] += 1
+        self.items = [
+                (codes, count, tables[n])
+                for (codes, n), count in counts.items()
+        ]
+        self.letters = sorted({code for word in get_words(crypt)
+                               for code in word})
+
+        # This maps each cipher letter to the items that contain it.
+        self.letter_items = [[] for _ in range(26)]
+        for item_idx, (codes, _, _) in enumerate(self.items):
+            for code in set(codes):
+                self.letter_items[code].append(item_idx)
+
+        # This lazily maps (a, b) with a < b to the items containing a or b.
+        self.pair_items = {}
+
+        # These are the distinct cipher words, as (codes, count) pairs, and,
+        # for each cipher letter, the indexes of the words containing it.
+        self.word_costs   = word_costs
+        self.word_items   = []
+        self.letter_words = [[] for _ in range(26)]
+        if word_costs:
+            word_counts = Counter(re.findall(r"([a-z]+)(?:'[a-z]+)?",
+                                             crypt.lower()))
+            for word, count in word_counts.items():
+                codes = tuple(ord(c) - ord('a') for c in word)
+                for code in set(codes):
+                    self.letter_words[code].append(len(self.word_items))
+                self.word_items.append((codes, count))
+
+    def get_word_bonus(self, key, codes, count):
+        """ Return what the cipher word `codes`, occurring `count` times, adds
+            to the score of `key`.
+        """
+        word = ''.join([chr(ord('a') + key[code]) for code in codes])
+        cost = self.word_costs.get(word)
+        if cost is None:
+            return 0
+        return count * max(0, WORD_BONUS * len(codes) - cost)
+
+    def score(self, key):
+        total = 0
+        for codes, count, table in self.items:
+            idx = 0
+            for code in codes:
+                idx = idx * 26 + key[code]
+            total += count * table[idx]
+        for codes, count in self.word_items:
+            total += self.get_word_bonus(key, codes, count)
+        return total
+
+    def get_swap_delta(self, key, a, b):
+        """ Return the change in score(key) from swapping key[a] and key[b].
+            Only the n-grams containing cipher letter a or b are rescored.
+        """
+        pair = (a, b) if a < b else (b, a)
+        items = self.pair_items.get(pair)
+        if items is None:
+            item_idxs = set(self.letter_items[a]) | set(self.letter_items[b])
+            items = [self.items[item_idx] for item_idx in sorted(item_idxs)]
+            self.pair_items[pair] = items
+
+        key_a, key_b = key[a], key[b]
+        delta = 0
+        for codes, count, table in items:
+            old_idx = new_idx = 0
+            for code in codes:
+                plain = key[code]
+                old_idx = old_idx * 26 + plain
+                if code == a:
+                    plain = key_b
+                elif code == b:
+                    plain = key_a
+                new_idx = new_idx * 26 + plain
+            delta += count * (table[new_idx] - table[old_idx])
+
+        if self.word_items:
+            word_idxs = set(self.letter_words[a]) | set(self.letter_words[b])
+            if word_idxs:
+                new_key = list(key)
+                new_key[a], new_key[b] = key_b, key_a
+                for word_idx in word_idxs:
+                    codes, count = self.word_items[word_idx]
+                    delta += (self.get_word_bonus(new_key, codes, count) -
+                              self.get_word_bonus(key, codes, count))
+        return delta
+
+
+# ______________________________________________________________________
+# Main
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(usage=__doc__)
+    parser.add_argument('--restarts', type=int)
+    parser.add_argument('--iterations', type=int)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--jobs', '-j', type=int)
+    parser.add_argument('--hybrid', action='store_true')
+    parser.add_argument('crypt', nargs='+')
+    args = parser.parse_args()
+
+    for name in ('restarts', 'iterations', 'jobs'):
+        value = getattr(args, name)
+        if value is not None and value < 1:
+            parser.error(f'--{name} must be at least 1.')
+    if args.hybrid and (args.restarts or args.jobs):
+        parser.error('--restarts and --jobs do not apply with --hybrid.')
+
+    # Each mode has its own default number of iterations.
+    if args.iterations is None:
+        args.iterations = N_HYBRID_ITERATIONS if args.hybrid else N_ITERATIONS
+    if args.restarts is None:
+        args.restarts = N_RESTARTS
+    if args.jobs is None:
+        args.jobs = 1
+
+    crypt = ' '.join(args.crypt)
+    if args.hybrid:
+        score, key = solve_hybrid(crypt, args.iterations, args.seed)
+    else:
+        score, key = solve(crypt, args.restarts, args.iterations, args.seed,
+                           args.jobs)
+    print(decrypt(crypt, key))
+    print(f'Key: {string.ascii_lowercase}')
+    print(f'     {key_to_str(key)}')
+    print(f'Score: {score:.2f}')